@@ -13,11 +13,12 @@ import tdose_build_mock_cube as tbmc
 def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
                xpos_col='xpos',ypos_col='ypos',sourcetype_col='sourcetype',
                spectype_col='spectype',fluxscale_col='fluxscale',
-               noisetype=None,noise_gauss_std=2.0,
-               psf=None,psf_param=[],psf_fft=False,
-               outputhdr=None,clobber=False,verbose=True):
+               noisetype=None,noise_gauss_std=2.0,noise_seed=None,
+               psf=None,psf_param=[],psf_fft=False,Nsigma=6.0,
+               outputhdr=None,compression=None,clobber=False,verbose=True):
     """
     Put together cube of dimensions [x,y,z] based on source catalog.
+    The cube is build and stored in single precision (float32).
 
     --- INPUT ---
     sourcecatalog    Cource catalog to build cube for. Expects catlog with (at least) four columns
@@ -42,10 +43,17 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
     noisetype        To add noise to output cube, defune type of noise with this keyword.
                      For Gaussian noise use noise_gauss_std to define the std of the Guassian PDF
     noise_gauss_std  The standard deviation of the Gaussian PDF used to generate Gaussian noise on cube
+    noise_seed       Seed for the random number generator used for Gaussian noise (None = unpredictable seed)
     psf              The PSF to convolve cube with in each wavelength layer.
     psf_param        The parameters of the PSF convolution kernel(s). See tdose_utilities.gen_psfed_cube() for details
     psf_fft          If true the PSF convolution wil be performed in Fourier space
+    Nsigma           The sources are only evaluated within Nsigma standard deviations of their centers
+                     (the contribution from outside 6 sigma is < 1e-7 of the peak value)
     outputhdr        use a specific hdr including wcs strucutre etc provide it here.
+    compression      To store the cubes as tile compressed images provide the compression type, e.g. 'RICE_1' or
+                     'GZIP_2' (see astropy.io.fits.CompImageHDU). The cubes are compressed with one tile per layer
+                     and stored in extensions 1 and up (the first of which is named DATA), i.e., with an empty
+                     primary extension. Note that compressing floating point data quantizes it (lossy).
     clobber          Clobber=True overwrites output fits file if it already exists
     verbose          Toggle verbosity
 
@@ -58,7 +66,16 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Loading source catalog information to build mock data cube for')
     try:
-        sourcedat = afits.open(sourcecatalog)[1].data
+        # reading the catalog columns once (copied out of the memory map) instead of indexing the FITS
+        # record array per object
+        with afits.open(sourcecatalog,memmap=True) as sourcehdu:
+            sourcedat   = sourcehdu[1].data
+            Nobjects    = len(sourcedat)
+            xpos        = np.asarray(sourcedat[xpos_col],dtype=float)
+            ypos        = np.asarray(sourcedat[ypos_col],dtype=float)
+            fluxscale   = np.asarray(sourcedat[fluxscale_col],dtype=float)
+            sourcetypes = np.asarray(sourcedat[sourcetype_col]).astype(str)
+            spectypes   = np.asarray(sourcedat[spectype_col]).astype(str)
     except:
         sys.exit(' ---> Problems loading fits source catalog for mock cube')
 
@@ -68,19 +85,24 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
         outname = outputname
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Generating sources and inserting them into mock cube')
-    Nobjects   = len(sourcedat)
-    outputcube = np.zeros(cube_dim)
+    outputcube = np.zeros(cube_dim,dtype=np.float32) # single precision is plenty for mock fluxes
 
-    for oo in np.arange(int(Nobjects)):
-        xpos       = sourcedat[xpos_col][oo]
-        ypos       = sourcedat[ypos_col][oo]
-        fluxscale  = sourcedat[fluxscale_col][oo]
-        sourcetype = sourcedat[sourcetype_col][oo]
-        spectype   = sourcedat[spectype_col][oo]
-        sourcecube = tbmc.gen_source_cube([ypos,xpos],fluxscale,sourcetype,spectype,cube_dim=cube_dim,
-                                          verbose=False,showsourceimgs=False)
+    # parsing the source and spectral types of all objects into numerical arrays in one go
+    isgauss     = np.char.startswith(sourcetypes,'gauss')
+    if not isgauss.all():
+        sys.exit(' ---> sourcetype="'+sourcetypes[~isgauss][0]+'" is not valid in call to mock_cube_sources.build_cube() ')
+    gaussparam  = np.array([sourcetype.split('_')[1:4] for sourcetype in sourcetypes],dtype=float).reshape(Nobjects,3)
+    sigmax, sigmay, angle = gaussparam[:,0], gaussparam[:,1], gaussparam[:,2]
 
-        outputcube = outputcube + sourcecube
+    islinear    = np.char.startswith(spectypes,'linear')
+    isflat      = np.char.startswith(spectypes,'flat')
+    if not (islinear | isflat).all():
+        sys.exit(' ---> spectype="'+spectypes[~(islinear | isflat)][0]+'" is not valid in call to mock_cube_sources.build_cube() ')
+    slope       = np.zeros(Nobjects)
+    slope[islinear] = np.array([spectype.split('_')[1] for spectype in spectypes[islinear]],dtype=float)
+
+    outputcube = tbmc.insert_gauss_sources(outputcube,ypos,xpos,sigmax,sigmay,angle,fluxscale,slope,
+                                           Nsigma=Nsigma,verbose=verbose)
 
     cleancube      = outputcube.copy()
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -92,9 +114,18 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if noisetype is not None:
         if verbose: ' - Adding noise to mock cube'
-        nonoisecube = outputcube.copy()
-        outputcube  = tu.gen_noisy_cube(outputcube,type=noisetype,gauss_std=noise_gauss_std,verbose=verbose)
-        noisecube   = outputcube - nonoisecube
+        if noisetype == 'gauss':
+            # generate the noise directly and add it in place instead of keeping a noise free copy around
+            noisecube   = np.random.default_rng(noise_seed).standard_normal(size=outputcube.shape,dtype=np.float32)
+            noisecube  *= np.float32(noise_gauss_std)
+            if psf is not None:
+                outputcube = outputcube.copy() # keep the CLEANPSF cube noise free
+            outputcube += noisecube
+        else:
+            nonoisecube = outputcube.copy()
+            outputcube  = tu.gen_noisy_cube(outputcube,type=noisetype,gauss_std=noise_gauss_std,
+                                            verbose=verbose).astype(np.float32)
+            noisecube   = outputcube - nonoisecube
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Saving generated mock cube to '+outname)
@@ -103,31 +134,33 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
     if outputhdr == None:
         if verbose: print('   No header provided so will generate one')
         # writing hdrkeys:    '---KEY--',                       '----------------MAX LENGTH COMMENT-------------'
-        hducube.header.append(('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),end=True)
-        hducube.header.append(('OBJECT '                      ,'mock_cube'),end=True)
-        hducube.header.append(('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),end=True)
-        hducube.header.append(('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),end=True)
-        hducube.header.append(('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD1_2  ',                  0.,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD2_1  ',                  0. ,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-        hducube.header.append(('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-        hducube.header.append(('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),end=True)
-        hducube.header.append(('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),end=True)
-        hducube.header.append(('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),end=True)
-        hducube.header.append(('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),end=True)
-        hducube.header.append(('CRVAL1 ',          53.1078417 ,' '),end=True)
-        hducube.header.append(('CRVAL2 ',         -27.8267356 ,' '),end=True)
-        hducube.header.append(('CTYPE3 ','AWAV    '           ,' '),end=True)
-        hducube.header.append(('CUNIT3 ','Angstrom'           ,' '),end=True)
-        hducube.header.append(('CD3_3  ',                1.25 ,' '),end=True)
-        hducube.header.append(('CRPIX3 ',                  1. ,' '),end=True)
-        hducube.header.append(('CRVAL3 ',    4800             ,' '),end=True)
-        hducube.header.append(('CD1_3  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD2_3  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD3_1  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD3_2  ',                  0. ,' '),end=True)
+        hdrcards = [
+                    ('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),
+                    ('OBJECT '                      ,'mock_cube'),
+                    ('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),
+                    ('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),
+                    ('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),
+                    ('CD1_2  ',                  0.,' Coordinate transformation matrix element'),
+                    ('CD2_1  ',                  0. ,' Coordinate transformation matrix element'),
+                    ('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),
+                    ('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),
+                    ('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),
+                    ('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),
+                    ('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),
+                    ('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),
+                    ('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),
+                    ('CRVAL1 ',          53.1078417 ,' '),
+                    ('CRVAL2 ',         -27.8267356 ,' '),
+                    ('CTYPE3 ','AWAV    '           ,' '),
+                    ('CUNIT3 ','Angstrom'           ,' '),
+                    ('CD3_3  ',                1.25 ,' '),
+                    ('CRPIX3 ',                  1. ,' '),
+                    ('CRVAL3 ',    4800             ,' '),
+                    ('CD1_3  ',                  0. ,' '),
+                    ('CD2_3  ',                  0. ,' '),
+                    ('CD3_1  ',                  0. ,' '),
+                    ('CD3_2  ',                  0. ,' ')]
+        hducube.header.extend(hdrcards,end=True)   # appending all keywords in one go
     else:
         hducube.header = outputhdr
 
@@ -160,12 +193,19 @@ def build_cube(sourcecatalog,cube_dim=[10,60,30],outputname='default',
         hdunoise.header.append(('EXTNAME ','NOISE'            ,'cube containing noise (sqrt(variance))'),end=True)
         hdustolist.append(hdunoise)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    if compression is not None:
+        if verbose: print('   Tile compressing cube extensions using '+compression+' (one tile per layer)')
+        tileshape  = (1,)+outputcube.shape[1:]
+        hdustolist = [afits.PrimaryHDU()] + \
+                     [afits.CompImageHDU(data=hdu.data,header=hdu.header,name=hdu.name if hdu.name != 'PRIMARY' else 'DATA',
+                                         compression_type=compression,tile_shape=tileshape) for hdu in hdustolist]
+
     hdulist = afits.HDUList(hdustolist)       # turn header into to hdulist
     hdulist.writeto(outname,overwrite=clobber)  # write fits file
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     return outname
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-def gen_source_cube(position,scale,sourcetype,spectype,cube_dim=[10,60,30],verbose=True,showsourceimgs=False):
+def gen_source_cube(position,scale,sourcetype,spectype,cube_dim=[10,60,30],Nsigma=6.0,verbose=True,showsourceimgs=False):
     """
     Generating a source to insert into model cube
 
@@ -184,6 +224,7 @@ def gen_source_cube(position,scale,sourcetype,spectype,cube_dim=[10,60,30],verbo
                                      (i,j) resulting from the flux_col scaling of the 0th layer in the cube (x,y,0)
                      file_fielname   An actual spectrum stored in file with name 'filename' and columns
                                      'wave' and 'flux'
+    Nsigma        The source is only evaluated within Nsigma standard deviations of its center
 
 
     --- EXAMPLE OF USE ---
@@ -198,41 +239,197 @@ def gen_source_cube(position,scale,sourcetype,spectype,cube_dim=[10,60,30],verbo
         stdx            = float(sourcetype.split('_')[1])
         stdy            = float(sourcetype.split('_')[2])
         angle           = float(sourcetype.split('_')[3])
-        cov             = tu.build_2D_cov_matrix(stdx,stdy,angle,verbose=verbose)
-        source_centered = tu.gen_2Dgauss(cube_dim[1:],cov,scale,show2Dgauss=showsourceimgs,verbose=verbose)
+        cov             = np.asarray(tu.build_2D_cov_matrix(stdx,stdy,angle,verbose=verbose))
     else:
         sys.exit(' ---> sourcetype="'+sourcetype+'" is not valid in call to mock_cube_sources.gen_source_cube() ')
 
     if verbose: print(' - Positioning source at requested pixel position (x,y) = ('+\
                       str(position[1])+','+str(position[0])+') in output cube')
-    position = np.asarray(position)
-    #source_positioned = tu.roll_2Dprofile(source_centered,position,showprofiles=showsourceimgs)
-    source_positioned = tu.shift_2Dprofile(source_centered,position,showprofiles=showsourceimgs,origin=1)
-
-    if verbose: print(' - Assemble flat spectrum cube with z-dimension '+str(cube_dim[0]))
-    sourcecube = np.stack([source_positioned]*cube_dim[0])
+    stamp, bbox       = tbmc.gen_source_stamp(position,scale,cov,cube_dim[1:],Nsigma=Nsigma)
+    source_positioned = np.zeros(cube_dim[1:])
+    source_positioned[bbox[0]:bbox[1],bbox[2]:bbox[3]] = stamp
 
     if verbose: print(' - Genrate wavelength dimension by scaling source according to spectype='+spectype)
-    if spectype.startswith('linear'):
-        slope           = float(spectype.split('_')[1])
-        slopestack      = np.stack([slope*np.arange(cube_dim[0])]*cube_dim[2], axis=1)
-        slopecube       = np.stack([slopestack]*cube_dim[1], axis=1)
-        sourcecube_out  = sourcecube + sourcecube * slopecube
-    elif spectype.startswith('flat'):
-        sourcecube_out  = sourcecube
-    else:
-        sys.exit(' ---> spectype="'+spectype+'" is not valid in call to mock_cube_sources.gen_source_cub(); '
-                                             'returning flat spectrum source ')
+    spectrum        = tbmc.gen_source_spectrum(spectype,cube_dim[0],verbose=False)
+    sourcecube_out  = source_positioned[None,:,:] * spectrum[:,None,None]
 
     if showsourceimgs:
         Nlayers = 4
         layers  = np.floor(np.linspace(0,cube_dim[0]-1,Nlayers)).astype(int)
         for layer in layers:
-            vmaxval = np.max(source_centered)
+            vmaxval = np.max(source_positioned)
             plt.imshow(sourcecube_out[layer,:,:],interpolation='none',vmin=-vmaxval, vmax=vmaxval)
             plt.title('Cube layer (z-slice) '+str(layer))
             plt.show()
 
 
     return sourcecube_out
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
\ No newline at end of file
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def get_stamp_bbox(cov,position,imgdim,Nsigma=6.0):
+    """
+    Get the bounding box of a 2D gaussian source in an image, i.e., the region the source
+    covers out to Nsigma standard deviations from its center, clipped to the image dimensions.
+
+    --- INPUT ---
+    cov           Covariance matrix of gaussian source (see tu.build_2D_cov_matrix)
+    position      Position of source in image (spatial dimensions): [ypos,xpos] (origin = 1)
+    imgdim        Dimensions of image: [ydim,xdim]
+    Nsigma        The number of standard deviations to include in the bounding box
+
+    --- EXAMPLE OF USE ---
+    import tdose_build_mock_cube as tbmc
+    cov  = tu.build_2D_cov_matrix(2.0,1.5,30,verbose=False)
+    bbox = tbmc.get_stamp_bbox(cov,[20,30],[60,50])
+
+    """
+    ycen, xcen = float(position[0])-1.0, float(position[1])-1.0
+    # marginal standard deviations along the image axes, i.e., the rotation of the source is accounted for
+    yhalf      = Nsigma*np.sqrt(cov[0,0])
+    xhalf      = Nsigma*np.sqrt(cov[1,1])
+
+    y0 = int(np.clip(np.floor(ycen-yhalf),  0,imgdim[0]))
+    y1 = int(np.clip(np.ceil(ycen+yhalf)+1, 0,imgdim[0]))
+    x0 = int(np.clip(np.floor(xcen-xhalf),  0,imgdim[1]))
+    x1 = int(np.clip(np.ceil(xcen+xhalf)+1, 0,imgdim[1]))
+
+    return y0, y1, x0, x1
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def gen_source_stamp(position,scale,cov,imgdim,Nsigma=6.0):
+    """
+    Generating the 2D image of a gaussian source evaluated only within its bounding box (see tbmc.get_stamp_bbox)
+
+    --- INPUT ---
+    position      Position of source in image (spatial dimensions): [ypos,xpos] (origin = 1)
+    scale         Flux scaling of source
+    cov           Covariance matrix of gaussian source (see tu.build_2D_cov_matrix)
+    imgdim        Dimensions of image the source is inserted in: [ydim,xdim]
+    Nsigma        The number of standard deviations to evaluate the source out to
+
+    --- EXAMPLE OF USE ---
+    import tdose_build_mock_cube as tbmc
+    cov         = tu.build_2D_cov_matrix(2.0,1.5,30,verbose=False)
+    stamp, bbox = tbmc.gen_source_stamp([20,30],5,cov,[60,50])
+    image       = np.zeros([60,50])
+    image[bbox[0]:bbox[1],bbox[2]:bbox[3]] = stamp
+
+    """
+    bbox  = tbmc.get_stamp_bbox(cov,position,imgdim,Nsigma=Nsigma)
+    yvec  = np.arange(bbox[0],bbox[1]) - (float(position[0])-1.0)
+    xvec  = np.arange(bbox[2],bbox[3]) - (float(position[1])-1.0)
+
+    stamp = tu.eval_2Dgauss(yvec,xvec,cov,scale)
+
+    return stamp, bbox
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def insert_gauss_sources(cube,ypos,xpos,sigmax,sigmay,angle,fluxscale,slope,Nsigma=6.0,verbose=True):
+    """
+    Inserting 2D gaussian sources with linear spectra into a cube (in place).
+    All source parameters are provided as numerical arrays, i.e., the source and spectral types from the
+    source catalog are expected to be parsed before calling this function (see tbmc.build_cube).
+
+    --- INPUT ---
+    cube          Cube to insert sources into (z,y,x). Will be modified in place.
+    ypos          Array with y pixel positions of sources (origin = 1)
+    xpos          Array with x pixel positions of sources (origin = 1)
+    sigmax        Array with standard deviations of the x-component of the 2D gaussians
+    sigmay        Array with standard deviations of the y-component of the 2D gaussians
+    angle         Array with rotation angles of the 2D gaussians (degrees)
+    fluxscale     Array with flux scalings of the sources
+    slope         Array with slopes of the linear spectra, i.e., the sources are scaled by (1 + slope*z).
+                  A flat spectrum corresponds to slope = 0.
+    Nsigma        The number of standard deviations out to which the sources are evaluated
+    verbose       Toggle verbosity
+
+    --- EXAMPLE OF USE ---
+    import tdose_build_mock_cube as tbmc
+    cube = np.zeros([10,60,50])
+    cube = tbmc.insert_gauss_sources(cube,[20,40],[30,10],[2.0,1.2],[1.5,1.2],[30,0],[5,2],[-0.01,0.0])
+
+    """
+    Nobjects = len(ypos)
+    layers   = np.arange(cube.shape[0])
+    if verbose: print(' - Inserting '+str(Nobjects)+' gaussian sources into cube')
+    if Nobjects == 0:
+        return cube
+
+    # Unit amplitude stamps are cached on the source shape and sub-pixel offset of the source center,
+    # so sources with identical morphologies (and pixel phases) only have their PDF evaluated once.
+    stamp_cache = {}
+
+    # scratch buffer (large enough for any source) to hold the spectrum*stamp product of each source in
+    halfmax = int(np.ceil(Nsigma*np.max(np.append(sigmax,sigmay))))
+    scratch = np.empty([cube.shape[0],min(2*halfmax+2,cube.shape[1]),min(2*halfmax+2,cube.shape[2])],dtype=cube.dtype)
+    image   = np.zeros(cube.shape[1:],dtype=cube.dtype)
+
+    # Sources sharing a spectrum are inserted together: their stamps are summed in 2D and the sum is inserted
+    # with a single (spectrum x image) outer product whenever that touches fewer pixels than inserting the
+    # sources one by one (i.e., when the sources overlap).
+    uniqueslopes, slopeindex = np.unique(slope,return_inverse=True)
+    for ss, slopeval in enumerate(uniqueslopes):
+        spectrum = (1.0 + slopeval*layers).astype(cube.dtype)
+        stamps   = []
+        bboxes   = []
+        for oo in np.where(slopeindex == ss)[0]:
+            ycen, xcen  = float(ypos[oo])-1.0, float(xpos[oo])-1.0
+            ypix, xpix  = int(np.floor(ycen)), int(np.floor(xcen))
+            stampkey    = (sigmax[oo],sigmay[oo],angle[oo],ycen-ypix,xcen-xpix)
+            if stampkey not in stamp_cache:
+                cov     = np.asarray(tu.build_2D_cov_matrix(sigmax[oo],sigmay[oo],angle[oo],verbose=False))
+                yhalf   = int(np.ceil(Nsigma*np.sqrt(cov[0,0])))
+                xhalf   = int(np.ceil(Nsigma*np.sqrt(cov[1,1])))
+                yvec    = np.arange(-yhalf,yhalf+2) - stampkey[3]
+                xvec    = np.arange(-xhalf,xhalf+2) - stampkey[4]
+                stamp_cache[stampkey] = tu.eval_2Dgauss(yvec,xvec,cov,1.0), yhalf, xhalf
+            stamp, yhalf, xhalf = stamp_cache[stampkey]
+
+            # clip stamp to the cube dimensions
+            y0, y1 = max(ypix-yhalf,0), min(ypix+yhalf+2,cube.shape[1])
+            x0, x1 = max(xpix-xhalf,0), min(xpix+xhalf+2,cube.shape[2])
+            if (y1 <= y0) or (x1 <= x0): continue
+            stamps.append(stamp[y0-(ypix-yhalf):y1-(ypix-yhalf),x0-(xpix-xhalf):x1-(xpix-xhalf)] * fluxscale[oo])
+            bboxes.append([y0,y1,x0,x1])
+
+        if len(stamps) == 0: continue
+        bboxes    = np.asarray(bboxes)
+        stamparea = np.sum((bboxes[:,1]-bboxes[:,0])*(bboxes[:,3]-bboxes[:,2]))
+        y0, y1    = np.min(bboxes[:,0]), np.max(bboxes[:,1])
+        x0, x1    = np.min(bboxes[:,2]), np.max(bboxes[:,3])
+
+        if (y1-y0)*(x1-x0) < stamparea:
+            image[y0:y1,x0:x1] = 0.0
+            for stamp, bbox in zip(stamps,bboxes):
+                image[bbox[0]:bbox[1],bbox[2]:bbox[3]] += stamp
+            cube[:,y0:y1,x0:x1] += np.multiply.outer(spectrum,image[y0:y1,x0:x1])
+        else:
+            for stamp, bbox in zip(stamps,bboxes):
+                slab = scratch[:,:bbox[1]-bbox[0],:bbox[3]-bbox[2]]
+                np.multiply(spectrum[:,None,None],stamp[None,:,:],out=slab)
+                cube[:,bbox[0]:bbox[1],bbox[2]:bbox[3]] += slab
+
+    return cube
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def gen_source_spectrum(spectype,Nlayers,verbose=True):
+    """
+    Generating the wavelength dependence (relative to the 0th layer) of a source
+
+    --- INPUT ---
+    spectype      String specifying the spectrum model to use for source (see tbmc.gen_source_cube)
+    Nlayers       Number of layers (z-dimension) to generate spectrum for
+    verbose       Toggle verbosity
+
+    --- EXAMPLE OF USE ---
+    import tdose_build_mock_cube as tbmc
+    spectrum = tbmc.gen_source_spectrum('linear_-0.01',100)
+
+    """
+    if verbose: print(' - Generating spectrum according to spectype='+spectype)
+    if spectype.startswith('linear'):
+        slope    = float(spectype.split('_')[1])
+        spectrum = 1.0 + slope*np.arange(Nlayers)
+    elif spectype.startswith('flat'):
+        spectrum = np.ones(Nlayers)
+    else:
+        sys.exit(' ---> spectype="'+spectype+'" is not valid in call to mock_cube_sources.gen_source_spectrum() ')
+
+    return spectrum
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -3,6 +3,7 @@ import numpy as np
 import sys
 import astropy.io.fits as afits
 import collections
+import multiprocessing
 import tdose_utilities as tu
 import tdose_extract_spectra as tes
 import tdose_build_mock_cube as tbmc
@@ -14,7 +15,7 @@ import matplotlib.pyplot as plt
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='tdose_spectrum',outputdir='./',clobber=False,
                     variance_cube_file=None,variance_cube_ext='ERROR',source_model_cube_file=None,source_cube_ext='DATA',
-                    model_cube_ext='DATA',layer_scale_ext='WAVESCL',data_cube_file=None,verbose=True):
+                    model_cube_ext='DATA',layer_scale_ext='WAVESCL',data_cube_file=None,Nprocesses=1,verbose=True):
     """
     Assemble the spectra determined by the wavelength layer scaling of the normalized models
     when generating the source model cube
@@ -33,6 +34,9 @@ def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='
     model_cube_ext                      Extension of model cube file that contains model
     layer_scale_ext                     Extension of model cube file that contains the layer scales
     data_cube_file                      File containing original data cube used for extraction of aperture spectra
+    Nprocesses                          Number of parallel processes to distribute the extraction of the objects over.
+                                        The processes are forked, so the (read-only) cubes are shared with them;
+                                        where forking is not possible the spectra are extracted serially.
     verbose
 
     --- EXAMPLE OF USE ---
@@ -41,13 +45,18 @@ def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='
     """
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Loading data needed for spectral assembly')
-    model_cube        = afits.open(model_cube_file)[model_cube_ext].data
-    model_cube_hdr    = afits.open(model_cube_file)[model_cube_ext].header
-    layer_scale_arr   = afits.open(model_cube_file)[layer_scale_ext].data
+    # files are memory mapped so only the parts of the (source model) cubes used for the extractions are read
+    with afits.open(model_cube_file,memmap=True) as modelhdu: # open file once and grab all extensions needed
+        model_cube_hdr    = modelhdu[model_cube_ext].header
+        layer_scale_arr   = np.array(modelhdu[layer_scale_ext].data)
     if variance_cube_file is not None:
-        stddev_cube       = np.sqrt(afits.open(variance_cube_file)[variance_cube_ext].data) # turn varinace into standard deviation
-        source_model_cube = afits.open(source_model_cube_file)[source_cube_ext].data
+        with afits.open(variance_cube_file,memmap=True) as variancehdu:
+            variance_cube     = variancehdu[variance_cube_ext].data
+        stddev_cube       = np.sqrt(variance_cube,dtype=np.float32) # turn varinace into standard deviation
+        with afits.open(source_model_cube_file,memmap=True) as sourcemodelhdu:
+            source_model_cube = sourcemodelhdu[source_cube_ext].data
     else:
+        variance_cube     = None
         stddev_cube       = None
         source_model_cube = None
     Nsources = layer_scale_arr.shape[0]
@@ -55,7 +64,8 @@ def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if data_cube_file is not None:
         if verbose: print(' - Loading data cube ')
-        data_cube  = afits.open(data_cube_file)[model_cube_ext].data
+        with afits.open(data_cube_file,memmap=True) as datahdu:
+            data_cube  = datahdu[model_cube_ext].data
     else:
         data_cube  = None
 
@@ -63,9 +73,7 @@ def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='
     if source_association_dictionary is None:
         if verbose: print(' - Building default source association dictionary ' \
                           '(determining what sources are combined into objects), i.e., one source per object ')
-        sourcIDs_dic = collections.OrderedDict()
-        for oo in np.arange(int(Nsources)):
-            sourcIDs_dic[str(oo)] = [oo]
+        sourcIDs_dic = collections.OrderedDict((str(oo),[oo]) for oo in range(int(Nsources)))
     else:
         sourcIDs_dic = source_association_dictionary
     Nobj = len(list(sourcIDs_dic.keys()))
@@ -75,35 +83,75 @@ def extract_spectra(model_cube_file,source_association_dictionary=None,nameext='
     if verbose: print(' - Assembling wavelength vector for spectra ')
     wavelengths     =  np.arange(model_cube_hdr['NAXIS3'])*model_cube_hdr['CD3_3']+model_cube_hdr['CRVAL3']
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    objkeys   = list(sourcIDs_dic.keys())
+    specids   = []
     specfiles = []
-    for oo, key in enumerate(sourcIDs_dic.keys()):
-        obj_cube_hdr = model_cube_hdr.copy()
+    for key in objkeys:
         try:
             specid       = str("%.10d" % int(key))
         except:
             specid       = str(key)
-        specname     = outputdir+nameext+'_'+specid+'.fits'
-        specfiles.append(specname)
-        sourceIDs    = sourcIDs_dic[key]
-
-        obj_cube_hdr.append(('OBJID   ',specid         ,'ID of object'),end=True)
-        obj_cube_hdr.append(('SRCIDS  ',str(sourceIDs) ,'IDs of sources combined in object'),end=True)
-
-        if verbose:
-            infostr = ' - Extracting spectrum '+str("%6.f" % (oo+1))+' / '+str("%6.f" % Nobj)
-            sys.stdout.write("%s\r" % infostr)
-            sys.stdout.flush()
-
-        sourceoutput = tes.extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=stddev_cube,
-                                            source_model_cube=source_model_cube, data_cube=data_cube,
-                                            specname=specname,obj_cube_hdr=obj_cube_hdr,clobber=clobber,verbose=True)
+        specids.append(specid)
+        specfiles.append(outputdir+nameext+'_'+specid+'.fits')
+
+    all_layer_scales_one = (np.min(layer_scale_arr) == 1) & (np.max(layer_scale_arr) == 1)
+    spectable            = tes.gen_spectable(wavelengths) # filled and saved for each object
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def extraction_worker(objents):
+        """
+        Extract the spectra of the objects with the provided entries in objkeys
+        """
+        for oo in objents:
+            obj_cube_hdr = model_cube_hdr.copy()
+            sourceIDs    = sourcIDs_dic[objkeys[oo]]
+
+            obj_cube_hdr.append(('OBJID   ',specids[oo]    ,'ID of object'),end=True)
+            obj_cube_hdr.append(('SRCIDS  ',str(sourceIDs) ,'IDs of sources combined in object'),end=True)
+
+            if verbose & (Nprocesses <= 1): # progress lines of parallel processes would overwrite each other
+                infostr = ' - Extracting spectrum '+str("%6.f" % (oo+1))+' / '+str("%6.f" % Nobj)
+                sys.stdout.write("%s\r" % infostr)
+                sys.stdout.flush()
+
+            sourceoutput = tes.extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=stddev_cube,
+                                                variance_cube=variance_cube,all_layer_scales_one=all_layer_scales_one,
+                                                spectable=spectable,
+                                                source_model_cube=source_model_cube, data_cube=data_cube,
+                                                specname=specfiles[oo],obj_cube_hdr=obj_cube_hdr,clobber=clobber,
+                                                verbose=(Nprocesses <= 1))
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    Nprocesses = int(np.min([Nprocesses,Nobj]))
+    if (Nprocesses > 1) & ('fork' not in multiprocessing.get_all_start_methods()):
+        if verbose: print(' - WARNING: Processes can not be forked on this platform; extracting the spectra in a single process')
+        Nprocesses = 1
+
+    if Nprocesses <= 1:
+        extraction_worker(np.arange(int(Nobj)))
+    else:
+        if verbose: print(' - Distributing extraction of the '+str(Nobj)+' objects over '+str(Nprocesses)+' processes '
+                          '(no progress reported by the processes)')
+        # forking the processes (independent of the default start method) so they inherit extraction_worker and
+        # the loaded cubes without copying them
+        forkcontext = multiprocessing.get_context('fork')
+        jobs = []
+        for pp, objents in enumerate(np.array_split(np.arange(int(Nobj)),Nprocesses)):
+            job = forkcontext.Process(target=extraction_worker,args=(objents,),name='extractionNo'+str(pp+1))
+            jobs.append(job)
+            job.start()
+
+        for job in jobs:
+            job.join()
+
+        failedjobs = [job.name for job in jobs if job.exitcode != 0]
+        if len(failedjobs) > 0:
+            sys.exit(' ---> The extraction processes '+str(failedjobs)+' did not finish successfully')
 
     if verbose: print('\n - Done extracting spectra. Returning list of fits files generated')
     return specfiles
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=None,source_model_cube=None,
                      specname='tdose_extract_spectra_extractedspec.fits',obj_cube_hdr=None,data_cube=None,
-                     clobber=False,verbose=True):
+                     clobber=False,variance_cube=None,all_layer_scales_one=None,spectable=None,verbose=True):
     """
     Extracting a spectrum based on the layer scale image from the model cube provided a list of sources to combine.
     Noise is estimated from the noise cube (of the data)
@@ -125,6 +173,12 @@ def extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=None,sourc
     data_cube         In case all layers scales are 1, it is assumed that the source_model_cube contains a mask for the
                       spectral extraction, which will then be performed on this data_cube.
     clobber           To overwrite existing files set clobber=True
+    variance_cube     The variance cube (noise_cube**2) of the data. If provided it is used directly when summing
+                      variances instead of squaring the noise_cube for every extracted object.
+    all_layer_scales_one  Set to True (False) if all values in layer_scale_arr are (not) 1. If None this is determined
+                      from layer_scale_arr. Set when extracting many objects to avoid re-checking the full array.
+    spectable         Binary table HDU from tes.gen_spectable(wavelengths) to fill with the extracted spectrum and save.
+                      Provide when extracting many objects to avoid building a new table for every spectrum.
     verbose           Toggle verbosity
 
     --- EXAMPLE OF USE ---
@@ -151,32 +205,39 @@ def extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=None,sourc
     if verbose: print(' - Assembling object spectrum from source scaling')
     source_ent = np.asarray(sourceIDs).astype(int)
 
-    if (layer_scale_arr == 1).all():
+    if all_layer_scales_one is None:
+        all_layer_scales_one = (layer_scale_arr == 1).all()
+
+    if all_layer_scales_one:
         if verbose: print(' - All layer scales are 1; assuming source model cube contain mask for spectral extraction')
-        object_cube  = np.sum(np.abs(source_model_cube[source_ent,:,:]),axis=0)
+        if len(source_ent) == 1:
+            object_cube  = np.abs(source_model_cube[source_ent[0],:,:,:])
+        else:
+            object_cube  = np.sum(np.abs(source_model_cube[source_ent,:,:,:]),axis=0)
         if data_cube is None:
             sys.exit(' ---> Did not find a data cube to extrac spectra from as expected')
 
         object_mask     = (object_cube == 0) # masking all zeros in object mask
-        invalid_mask    = np.ma.masked_invalid(data_cube).mask
+        invalid_mask    = ~np.isfinite(data_cube)
         comb_mask       = (invalid_mask | object_mask)
-        spec_1D_masked  = np.sum(np.sum(  np.ma.array(data_cube,mask=comb_mask)  ,axis=1),axis=1)
-        spec_1D         = spec_1D_masked.filled(fill_value=0.0)
+        spec_1D         = np.sum(np.where(comb_mask,0.0,data_cube),axis=(1,2))
 
         if noise_cube is not None:
             if verbose: print('   Calculating noise as d_spec_k = sqrt( SUMij d_pix_ij**2 ), i.e., as the sqrt of variances summed')
-            invalid_mask_noise = np.ma.masked_invalid(noise_cube).mask
+            invalid_mask_noise = ~np.isfinite(noise_cube)
             comb_mask          = (comb_mask | invalid_mask_noise)
-            variance_1D_masked = np.ma.array(noise_cube,mask=comb_mask)**2
-            noise_1D_masked    = np.sqrt( np.sum( np.sum( variance_1D_masked, axis=1), axis=1) )
-            noise_1D           = noise_1D_masked.filled(fill_value=np.nan)
+            if variance_cube is None:
+                variance_cube  = noise_cube**2
+            variance_1D        = np.sum(np.where(comb_mask,0.0,variance_cube),axis=(1,2))
+            noise_1D           = np.sqrt(variance_1D)
+            noise_1D[comb_mask.all(axis=(1,2))] = np.nan # no valid pixels in layer
 
             if verbose: print('   Generating S/N vector')
             SN_1D         = spec_1D / noise_1D
         else:
             if verbose: print(' - No "noise_cube" provided. Setting all errors and S/N values to NaN')
-            SN_1D    = np.zeros(spec_1D.shape)*np.NaN
-            noise_1D = np.zeros(spec_1D.shape)*np.NaN
+            SN_1D    = np.full(spec_1D.shape,np.nan)
+            noise_1D = np.full(spec_1D.shape,np.nan)
     else:
         if verbose: print(' - Some layer scales are different from 1; hence assembling spectra using layer scales')
         if len(source_ent) < 1:
@@ -188,54 +249,53 @@ def extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=None,sourc
         if noise_cube is not None:
             if verbose: print(' - Estimate S/N at each wavelength for 1D spectrum (see Eq. 16 of Kamann+2013)')
             if verbose: print('   Estimating fraction of flux in each pixel wrt. total flux in each layer')
-            object_cube    = np.sum((source_model_cube[source_ent,:,:,:]),axis=0) # summing source models for all source IDs
+            if len(source_ent) == 1: # single source objects (the default); no need to sum over source models
+                object_cube    = source_model_cube[source_ent[0],:,:,:]
+                fluxfrac_cube  = object_cube / layer_scale_arr[source_ent[0],:][:,None,None]
+            else:
+                object_cube    = np.sum((source_model_cube[source_ent,:,:,:]),axis=0) # summing source models for all source IDs
 
-            fluxfrac_cube_sents = np.zeros(source_model_cube.shape[1:])
-            for sent in source_ent:
-                object_cube_sent      = np.sum((source_model_cube[[sent],:,:,:]),axis=0) # getting source model for model 'sent'
-                fluxscale1D_sent      = layer_scale_arr[sent,:]
-                fluxfrac_cube_sent    = object_cube_sent / fluxscale1D_sent[:,None,None]
-                fluxfrac_cube_sents   = fluxfrac_cube_sents + fluxfrac_cube_sent
-            fluxfrac_cube = fluxfrac_cube_sents / len(source_ent) # renormalizing flux-fraction cube
+                # summing source models divided by their layer scales in one contraction over the source IDs
+                fluxfrac_cube  = np.einsum('swyx,sw->wyx',source_model_cube[source_ent,:,:,:],
+                                           1.0/layer_scale_arr[source_ent,:])
+                fluxfrac_cube /= len(source_ent) # renormalizing flux-fraction cube
 
             if verbose: print('   Defining pixel mask (ignoring NaN pixels) ') #+\
             #                  'and pixels with <'+str(fluxfrac_min)+' of total pixel flux in model cube) '
             # pix_mask      = (fluxfrac_cube < fluxfrac_min)
-            invalid_mask1 = np.ma.masked_invalid(fluxfrac_cube).mask
-            invalid_mask2 = np.ma.masked_invalid(noise_cube).mask
+            invalid_mask1 = ~np.isfinite(fluxfrac_cube)
+            invalid_mask2 = ~np.isfinite(noise_cube)
 
             # combining mask making sure all individual mask pixels have True for it to be true in combined mask
             comb_mask     = (invalid_mask1 | invalid_mask2) # | pix_mask
 
             if verbose: print('   Calculating noise propogated as d_spec_k = 1/sqrt( SUMij (fluxfrac_ij**2 / d_pix_ij**2) )')
-            squared_ratio     = np.ma.array(fluxfrac_cube,mask=comb_mask)**2 / np.ma.array(noise_cube,mask=comb_mask)**2
+            goodpix           = ~(comb_mask | (noise_cube == 0))
+            fluxfrac_ratio    = np.divide(fluxfrac_cube,noise_cube,out=np.zeros(fluxfrac_cube.shape,dtype=np.float32),
+                                          where=goodpix) # single precision is sufficient for the noise estimate
 
-            inv_noise_masked  = np.sqrt( np.sum( np.sum( squared_ratio, axis=1), axis=1) )
-            noise_1D          = (1.0/inv_noise_masked).filled(fill_value=0.0)
+            inv_noise         = np.sqrt( np.einsum('wyx,wyx->w',fluxfrac_ratio,fluxfrac_ratio) )
+            with np.errstate(divide='ignore'):
+                noise_1D      = np.where(inv_noise > 0,1.0/inv_noise,0.0)
             if verbose: print('   Generating S/N vector')
             SN_1D         = spec_1D / noise_1D
         else:
             if verbose: print(' - No "noise_cube" provided. Setting all errors and S/N values to NaN')
-            SN_1D    = np.zeros(spec_1D.shape)*np.NaN
-            noise_1D = np.zeros(spec_1D.shape)*np.NaN
+            SN_1D    = np.full(spec_1D.shape,np.nan)
+            noise_1D = np.full(spec_1D.shape,np.nan)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Saving extracted 1D spectrum and source cube to \n   '+specname)
     mainHDU = afits.PrimaryHDU()       # primary HDU
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-    c1 = afits.Column(name='wave',      format='D', unit='ANGSTROMS', array=wavelengths)
-    c2 = afits.Column(name='flux',      format='D', unit='', array=spec_1D)
-    c3 = afits.Column(name='fluxerror', format='D', unit='', array=noise_1D)
-    c4 = afits.Column(name='s2n',       format='D', unit='', array=SN_1D)
-
-    coldefs = afits.ColDefs([c1,c2,c3,c4])
-    th = afits.BinTableHDU.from_columns(coldefs) # creating default header
-
-    # writing hdrkeys:'---KEY--',                             '----------------MAX LENGTH COMMENT-------------'
-    th.header.append(('EXTNAME ','SPEC1D'                     ,'cube containing source'),end=True)
-    head    = th.header
+    if spectable is None:
+        tbHDU = tes.gen_spectable(wavelengths)
+    else:
+        tbHDU = spectable
 
-    tbHDU  = afits.BinTableHDU.from_columns(coldefs, header=head)
+    tbHDU.data['flux']      = spec_1D
+    tbHDU.data['fluxerror'] = noise_1D
+    tbHDU.data['s2n']       = SN_1D
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if obj_cube_hdr is not None:
         objHDU        = afits.ImageHDU(object_cube)
@@ -259,6 +319,33 @@ def extract_spectrum(sourceIDs,layer_scale_arr,wavelengths,noise_cube=None,sourc
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     return wavelengths, spec_1D, noise_1D, object_cube
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def gen_spectable(wavelengths):
+    """
+    Generate the binary table HDU (SPEC1D) the 1D spectra from tes.extract_spectrum() are stored in.
+    The flux, fluxerror and s2n columns are filled with NaNs.
+
+    --- INPUT ---
+    wavelengths       Wavelength vector of the 1D spectra
+
+    --- EXAMPLE OF USE ---
+    import tdose_extract_spectra as tes
+    spectable = tes.gen_spectable(np.arange(4750.0,9350.0,1.25))
+
+    """
+    nanvec = np.full(len(wavelengths),np.nan)
+    c1 = afits.Column(name='wave',      format='D', unit='ANGSTROMS', array=wavelengths)
+    c2 = afits.Column(name='flux',      format='D', unit='', array=nanvec)
+    c3 = afits.Column(name='fluxerror', format='D', unit='', array=nanvec)
+    c4 = afits.Column(name='s2n',       format='D', unit='', array=nanvec)
+
+    coldefs = afits.ColDefs([c1,c2,c3,c4])
+    tbHDU = afits.BinTableHDU.from_columns(coldefs) # creating default header
+
+    # writing hdrkeys:'---KEY--',                             '----------------MAX LENGTH COMMENT-------------'
+    tbHDU.header.append(('EXTNAME ','SPEC1D'                     ,'cube containing source'),end=True)
+
+    return tbHDU
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def extract_spectra_viasourcemodelcube(datacube,sourcemodelcube,wavelengths,speclist,specids='None',outputdir='./',
                                        noisecube=False,sourcemodel_hdr='None',verbose=True):
     """
@@ -364,17 +451,25 @@ def extract_spectrum_viasourcemodelcube(datacube,sourceweights,wavelengths,
 
     if verbose: print(' - Assuming uncertainty on source weights equals the datanoise when propgating errors')
     sourceweights_err = datanoise
-    sourcecube_err    = sourcecube * np.sqrt( (datanoise/datacube)**2 + (sourceweights_err/sourceweights)**2 )
+    # sourcecube * sqrt( (datanoise/datacube)**2 + (sourceweights_err/sourceweights)**2 ) without the divisions
+    sourcecube_err    = np.hypot(datanoise*sourceweights,sourceweights_err*datacube)
+    sourcecube_err   *= np.sign(sourcecube)
+    sourcecube_err[sourcecube == 0] = np.nan # relative errors undefined for zero data or weights
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print(' - Generating 1D spectrum from source cube via:')
     spec_wave   = wavelengths
-    maskinvalid = np.ma.masked_invalid(sourcecube * sourcecube_err).mask
+    maskinvalid = ~np.isfinite(sourcecube) | ~np.isfinite(sourcecube_err)
     if spec1Dmethod == 'sum':
         if verbose: print('   Simple summation of fluxes in sourcecube.')
-        spec_flux = np.sum(np.sum(np.ma.array(sourcecube,mask=maskinvalid),axis=1),axis=1).filled()
+        spec_flux = np.sum(np.where(maskinvalid,0.0,sourcecube),axis=(1,2))
         if verbose: print('   Errors are propagated as sum of squares.')
-        spec_err  = np.sqrt( np.sum( np.sum(np.ma.array(sourcecube_err,mask=maskinvalid)**2,axis=1),axis=1) ).filled()
+        sourcecube_err_clean = np.where(maskinvalid,0.0,sourcecube_err)
+        spec_err  = np.sqrt( np.einsum('wyx,wyx->w',sourcecube_err_clean,sourcecube_err_clean) )
+
+        layermask = maskinvalid.all(axis=(1,2)) # no valid pixels in layer
+        spec_flux[layermask] = np.nan
+        spec_err[layermask]  = np.nan
     elif spec1Dmethod == 'sum_SNweight':
         pdb.set_trace()
     else:
@@ -389,14 +484,11 @@ def extract_spectrum_viasourcemodelcube(datacube,sourceweights,wavelengths,
     c3 = afits.Column(name='fluxerror', format='D', unit='', array=spec_err)
 
     coldefs = afits.ColDefs([c1,c2,c3])
-    th = afits.BinTableHDU.from_columns(coldefs) # creating default header
+    tbHDU = afits.BinTableHDU.from_columns(coldefs) # creating default header
 
     # writing hdrkeys:'---KEY--',                             '----------------MAX LENGTH COMMENT-------------'
-    th.header.append(('EXTNAME ','SPEC1D'                     ,'cube containing source'),end=True)
-    th.header.append(('SPECMETH' , spec1Dmethod               ,'Method used for spectral extraction'),end=True)
-    head    = th.header
-
-    tbHDU  = afits.BinTableHDU.from_columns(coldefs, header=head)
+    tbHDU.header.append(('EXTNAME ','SPEC1D'                     ,'cube containing source'),end=True)
+    tbHDU.header.append(('SPECMETH' , spec1Dmethod               ,'Method used for spectral extraction'),end=True)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if sourcecube_hdr != 'None':
@@ -491,34 +583,48 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
     for unitspec in filelist:
 
         if bunit == 'BUNIT FLUX':
-            try:
-                sourcecubehdr = afits.open(unitspec)['SOURCECUBE'].header
-                bunit         = sourcecubehdr['BUNIT']
-            except:
-                try: # Backwards compatibility to TDOSE v2.0 extractions
-                    sourcecubehdr = afits.open(unitspec)[2].header
+            with afits.open(unitspec) as unithdu:
+                try:
+                    sourcecubehdr = unithdu['SOURCECUBE'].header
                     bunit         = sourcecubehdr['BUNIT']
                 except:
-                    pass
+                    try: # Backwards compatibility to TDOSE v2.0 extractions
+                        sourcecubehdr = unithdu[2].header
+                        bunit         = sourcecubehdr['BUNIT']
+                    except:
+                        pass
     if bunit == 'BUNIT FLUX':
         if verbose: print(' - Did not find BUNIT in SOURCECUBE header for any spectra in filelist - are they not from TDOSE?')
 
+    if pubversion: # only the publication version is rendered with LaTeX; mathtext is much faster
+        angstrom = r'\AA'
+    else:
+        angstrom = r'$\mathrm{\AA}$'
+
     if bunit == '10**(-20)*erg/s/cm**2/Angstrom': # Making bunit LaTeXy for MUSE-Wide BUNIT format
-        bunit = '1e-20 erg/s/cm$^2$/\AA'
+        bunit = '1e-20 erg/s/cm$^2$/'+angstrom
     else:
         bunit = '$'+bunit+'$' # minimizing pronlems with LaTeXing plot axes
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     lthick = 1
-    plt.rc('text', usetex=True)
+    plt.rc('text', usetex=pubversion)
     plt.rc('font', family='serif',size=Fsize)
     plt.rc('xtick', labelsize=Fsize)
     plt.rc('ytick', labelsize=Fsize)
-    plt.clf()
     plt.ioff()
+    ax = fig.add_subplot(111)
     #plt.title(plotname.split('TDOSE 1D spectra'),fontsize=Fsize)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     for ff, specfile in enumerate(filelist):
-        specdat = afits.open(specfile)[1].data
+        with afits.open(specfile) as spechdu: # reading the columns needed once
+            specdat  = spechdu[1].data
+            specwave = np.array(specdat[tdose_wavecol])
+            specflux = np.array(specdat[tdose_fluxcol])
+            specerr  = np.array(specdat[tdose_errcol])
+            try:
+                specs2n = np.array(specdat['s2n'])
+            except:
+                specs2n = None
 
         if colors is None:
             spec_color = None
@@ -531,90 +637,104 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
             spec_label = labels[ff]
 
         if xrange is not None:
-            goodent = np.where((specdat[tdose_wavecol] > xrange[0]) & (specdat[tdose_wavecol] < xrange[1]))[0]
-            if goodent == []:
+            ent_min = np.searchsorted(specwave,xrange[0],side='right') # wavelengths are sorted so range is a slice
+            ent_max = np.searchsorted(specwave,xrange[1],side='left')
+            goodent = slice(ent_min,ent_max)
+            if ent_max <= ent_min:
                 if verbose: print(' - The chosen xrange is not covered by the input spectrum. Plotting full spectrum')
-                goodent = np.arange(len(specdat[tdose_wavecol]))
+                goodent = slice(None)
         else:
-            goodent = np.arange(len(specdat[tdose_wavecol]))
+            goodent = slice(None)
+        wavedat  = specwave[goodent]
+        specflux = np.ascontiguousarray(specflux[goodent],dtype=float) # native-endian buffers for the filters
+        specerr  = np.ascontiguousarray(specerr[goodent],dtype=float)
 
         if plotSNcurve:
-            try:
-                s2ndat = specdat['s2n'][goodent]
-            except:
-                s2ndat = specdat[tdose_fluxcol][goodent]/specdat[tdose_errcol][goodent]
+            if specs2n is not None:
+                s2ndat = np.ascontiguousarray(specs2n[goodent],dtype=float)
+            else:
+                s2ndat = np.divide(specflux,specerr,out=np.full(len(wavedat),np.nan),where=(specerr != 0))
 
             if smooth > 0:
                 s2ndat = snf.gaussian_filter(s2ndat, smooth)
 
             if not plotratio:
-                plt.plot(specdat[tdose_wavecol][goodent],s2ndat,color=spec_color,lw=lthick, label=spec_label)
+                ax.plot(wavedat,s2ndat,color=spec_color,lw=lthick, label=spec_label)
                 ylabel = 'S/N'
             else:
-                plt.plot(specdat[tdose_wavecol][goodent],s2ndat/s2ndat,color=spec_color,lw=lthick, label=None)
+                ax.plot(wavedat,s2ndat/s2ndat,color=spec_color,lw=lthick, label=None)
                 ylabel = 'S/N ratio'
             #plotname = plotname.replace('.pdf','_S2N.pdf')
         else:
             fillalpha = 0.30
-            fluxdat   = specdat[tdose_fluxcol][goodent]
-            errlow    = specdat[tdose_fluxcol][goodent]-specdat[tdose_errcol][goodent]
-            errhigh   = specdat[tdose_fluxcol][goodent]+specdat[tdose_errcol][goodent]
-
-            if smooth > 0:
-                fluxdat = snf.gaussian_filter(fluxdat, smooth)
-                errlow      = snf.gaussian_filter(errlow,  smooth)
-                errhigh     = snf.gaussian_filter(errhigh, smooth)
-
+            fluxdat   = specflux
             if smooth > 0:
                 fluxdat = snf.gaussian_filter(fluxdat, smooth)
 
             if not plotratio:
-                if shownoise:
-                    plt.fill_between(specdat[tdose_wavecol][goodent],errlow,errhigh,
-                                     alpha=fillalpha,color=spec_color)
-
-                plt.plot(specdat[tdose_wavecol][goodent],fluxdat,
-                         color=spec_color,lw=lthick, label=spec_label)
+                if shownoise: # smoothing is linear, so smoothing flux and error is enough for the error envelope
+                    errdat    = specerr
+                    if smooth > 0:
+                        errdat = snf.gaussian_filter(errdat, smooth)
+                    errlow    = fluxdat-errdat
+                    errhigh   = fluxdat+errdat
+
+                    ax.fill_between(wavedat,errlow,errhigh,
+                                    alpha=fillalpha,color=spec_color)
+
+                ax.plot(wavedat,fluxdat,
+                        color=spec_color,lw=lthick, label=spec_label)
                 ylabel = tdose_fluxcol
             else:
-                plt.plot(specdat[tdose_wavecol][goodent],fluxdat/fluxdat,
-                         color=spec_color,lw=lthick, label=None)
+                ax.plot(wavedat,fluxdat/fluxdat,
+                        color=spec_color,lw=lthick, label=None)
                 ylabel = tdose_fluxcol+' ratio '
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if simsources is not None:
-        sim_total = np.zeros(len(specdat[tdose_wavecol]))
-        for sourcenumber in simsources:
-            sourcedat = afits.open(simsourcefile)[1].data
-            xpos       = sourcedat['xpos'][sourcenumber]
-            ypos       = sourcedat['ypos'][sourcenumber]
-            fluxscale  = sourcedat['fluxscale'][sourcenumber]
-            sourcetype = sourcedat['sourcetype'][sourcenumber]
-            spectype   = sourcedat['spectype'][sourcenumber]
-            sourcecube = tbmc.gen_source_cube([ypos,xpos],fluxscale,sourcetype,spectype,cube_dim=sim_cube_dim,
-                                              verbose=verbose,showsourceimgs=False)
-
-            simspec    = np.sum( np.sum(sourcecube, axis=1), axis=1)
+        sim_total = np.zeros(len(specwave))
+        with afits.open(simsourcefile) as simsourcehdu:
+            sourcedat = simsourcehdu[1].data[simsources]
+        for ss, sourcenumber in enumerate(simsources):
+            xpos       = sourcedat['xpos'][ss]
+            ypos       = sourcedat['ypos'][ss]
+            fluxscale  = sourcedat['fluxscale'][ss]
+            sourcetype = sourcedat['sourcetype'][ss]
+            spectype   = sourcedat['spectype'][ss]
+            # the spatially integrated spectrum is the flux of the source image times the spectrum,
+            # so only a single layer is generated instead of the full source cube
+            sourceimg  = tbmc.gen_source_cube([ypos,xpos],fluxscale,sourcetype,'flat',
+                                              cube_dim=[1]+list(sim_cube_dim[1:]),verbose=verbose,showsourceimgs=False)
+            simspec    = np.sum(sourceimg) * tbmc.gen_source_spectrum(spectype,sim_cube_dim[0],verbose=False)
             sim_total  = sim_total + simspec
             if smooth > 0:
                 simspec = snf.gaussian_filter(simspec, smooth)
 
-            plt.plot(specdat[tdose_wavecol],simspec,'--',color='black',lw=lthick)
+            ax.plot(specwave,simspec,'--',color='black',lw=lthick)
 
-        plt.plot(specdat[tdose_wavecol],sim_total,'--',color='black',lw=lthick,
-                 label='Sim. spectrum: \nsimsource='+str(simsources))
+        ax.plot(specwave,sim_total,'--',color='black',lw=lthick,
+                label='Sim. spectrum: \nsimsource='+str(simsources))
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if comparisonspecs is not None:
         for cc, comparisonspec in enumerate(comparisonspecs):
-            compdat = afits.open(comparisonspec)[1].data
+            with afits.open(comparisonspec) as comphdu: # reading the columns needed once
+                compdat  = comphdu[1].data
+                compwave = np.array(compdat[comp_wavecol])
+                compflux = np.array(compdat[comp_fluxcol])
+                comperr  = np.array(compdat[comp_errcol])
 
             if xrange is not None:
-                goodent = np.where((compdat[comp_wavecol] > xrange[0]) & (compdat[comp_wavecol] < xrange[1]))[0]
-                if goodent == []:
+                ent_min = np.searchsorted(compwave,xrange[0],side='right') # wavelengths are sorted so range is a slice
+                ent_max = np.searchsorted(compwave,xrange[1],side='left')
+                goodent = slice(ent_min,ent_max)
+                if ent_max <= ent_min:
                     if verbose: print(' - The chosen xrange is not covered by the comparison spectrum. Plotting full spectrum')
-                    goodent = np.arange(len(compdat[comp_wavecol]))
+                    goodent = slice(None)
             else:
-                goodent = np.arange(len(compdat[comp_wavecol]))
+                goodent = slice(None)
+            compwave = compwave[goodent]
+            compflux = np.ascontiguousarray(compflux[goodent],dtype=float) # native-endian buffers for the filters
+            comperr  = np.ascontiguousarray(comperr[goodent],dtype=float)
 
             if comp_colors is None:
                 comp_color = None
@@ -627,52 +747,61 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
                 comp_label = comp_labels[cc]
 
             if plotSNcurve:
-                s2ncompdat = compdat[comp_fluxcol][goodent]/compdat[comp_errcol][goodent]
+                s2ncompdat = np.divide(compflux,comperr,out=np.full(len(compwave),np.nan),where=(comperr != 0))
                 if smooth > 0:
                     s2ncompdat = snf.gaussian_filter(s2ncompdat, smooth)
 
                 if not plotratio:
-                    plt.plot(compdat[comp_wavecol][goodent],s2ncompdat,
-                             color=comp_color,lw=lthick, label=comp_label)
+                    ax.plot(compwave,s2ncompdat,
+                            color=comp_color,lw=lthick, label=comp_label)
                 else:
-                    plt.plot(compdat[comp_wavecol][goodent],s2ndat/s2ncompdat,
-                             color=comp_color,lw=lthick, label=comp_label)
+                    ax.plot(compwave,s2ndat/s2ncompdat,
+                            color=comp_color,lw=lthick, label=comp_label)
 
             else:
                 fillalpha = 0.30
-                fluxcompdat = compdat[comp_fluxcol][goodent]
-                errlow      = compdat[comp_fluxcol][goodent]-compdat[comp_errcol][goodent]
-                errhigh     = compdat[comp_fluxcol][goodent]+compdat[comp_errcol][goodent]
-
+                fluxcompdat = compflux
                 if smooth > 0:
                     fluxcompdat = snf.gaussian_filter(fluxcompdat, smooth)
-                    errlow      = snf.gaussian_filter(errlow,  smooth)
-                    errhigh     = snf.gaussian_filter(errhigh, smooth)
-
 
                 if not plotratio:
                     if shownoise:
-                        plt.fill_between(compdat[comp_wavecol][goodent],errlow,errhigh,
-                                         alpha=fillalpha,color=comp_color)
+                        errcompdat  = comperr
+                        if smooth > 0:
+                            errcompdat = snf.gaussian_filter(errcompdat, smooth)
+                        errlow      = fluxcompdat-errcompdat
+                        errhigh     = fluxcompdat+errcompdat
+
+                        ax.fill_between(compwave,errlow,errhigh,
+                                        alpha=fillalpha,color=comp_color)
 
-                    plt.plot(compdat[comp_wavecol][goodent],fluxcompdat,
-                             color=comp_color,lw=lthick, label=comp_label)
+                    ax.plot(compwave,fluxcompdat,
+                            color=comp_color,lw=lthick, label=comp_label)
                 else:
-                    plt.plot(compdat[comp_wavecol][goodent],fluxdat/fluxcompdat,
-                             color=comp_color,lw=lthick, label=comp_label)
+                    ax.plot(compwave,fluxdat/fluxcompdat,
+                            color=comp_color,lw=lthick, label=comp_label)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if skyspecs is not None:
         for ss, skyspec in enumerate(skyspecs):
-            skydat = afits.open(skyspec)[1].data
+            with afits.open(skyspec) as skyhdu: # reading the columns needed once
+                skydat  = skyhdu[1].data
+                skywave = np.array(skydat[sky_wavecol])
+                skyflux = np.array(skydat[sky_fluxcol])
+                skyerr  = np.array(skydat[sky_errcol])
 
             if xrange is not None:
-                goodent = np.where((skydat[sky_wavecol] > xrange[0]) & (skydat[sky_wavecol] < xrange[1]))[0]
-                if goodent == []:
+                ent_min = np.searchsorted(skywave,xrange[0],side='right') # wavelengths are sorted so range is a slice
+                ent_max = np.searchsorted(skywave,xrange[1],side='left')
+                goodent = slice(ent_min,ent_max)
+                if ent_max <= ent_min:
                     if verbose: print(' - The chosen xrange is not covered by the sky spectrum. Plotting full spectrum')
-                    goodent = np.arange(len(skydat[sky_wavecol]))
+                    goodent = slice(None)
             else:
-                goodent = np.arange(len(skydat[sky_wavecol]))
+                goodent = slice(None)
+            skywave = skywave[goodent]
+            skyflux = np.ascontiguousarray(skyflux[goodent],dtype=float) # native-endian buffers for the filters
+            skyerr  = np.ascontiguousarray(skyerr[goodent],dtype=float)
 
             if sky_colors is None:
                 sky_color = None
@@ -685,38 +814,39 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
                 sky_label = sky_labels[ss]
 
             if plotSNcurve:
-                s2nsky = skydat[sky_fluxcol][goodent]/skydat[sky_errcol][goodent]
+                s2nsky = np.divide(skyflux,skyerr,out=np.full(len(skywave),np.nan),where=(skyerr != 0))
                 if smooth > 0:
                     s2nsky = snf.gaussian_filter(s2nsky, smooth)
 
-                plt.plot(skydat[sky_wavecol][goodent],s2nsky,
-                         color=sky_color,lw=lthick, label=sky_label)
+                ax.plot(skywave,s2nsky,
+                        color=sky_color,lw=lthick, label=sky_label)
             else:
                 fillalpha = 0.30
-                fluxsky   = skydat[sky_fluxcol][goodent]
-                errlow    = skydat[sky_fluxcol][goodent]-skydat[sky_errcol][goodent]
-                errhigh   = skydat[sky_fluxcol][goodent]+skydat[sky_errcol][goodent]
-
+                fluxsky   = skyflux
                 if smooth > 0:
                     fluxsky = snf.gaussian_filter(fluxsky, smooth)
-                    errlow  = snf.gaussian_filter(errlow,  smooth)
-                    errhigh = snf.gaussian_filter(errhigh, smooth)
 
                 if shownoise:
-                    plt.fill_between(skydat[sky_wavecol][goodent],errlow,errhigh,
-                                     alpha=fillalpha,color=sky_color)
+                    errsky    = skyerr
+                    if smooth > 0:
+                        errsky = snf.gaussian_filter(errsky, smooth)
+                    errlow    = fluxsky-errsky
+                    errhigh   = fluxsky+errsky
+
+                    ax.fill_between(skywave,errlow,errhigh,
+                                    alpha=fillalpha,color=sky_color)
 
-                plt.plot(skydat[sky_wavecol][goodent],fluxsky,
-                         color=sky_color,lw=lthick, label=sky_label)
+                ax.plot(skywave,fluxsky,
+                        color=sky_color,lw=lthick, label=sky_label)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if xrange is None:
         xvals = [4800,9300]
     else:
         xvals = xrange
-    plt.plot(xvals,[0,0],'--k',lw=lthick)
+    ax.plot(xvals,[0,0],'--k',lw=lthick)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-    plt.xlabel('Wavelength [\AA]', fontsize=Fsize)
+    ax.set_xlabel('Wavelength ['+angstrom+']', fontsize=Fsize)
 
     if pubversion:
         if plotSNcurve:
@@ -727,33 +857,34 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
         if plotratio:
             ylabel = ylabel+' ratio'
 
-    plt.ylabel(ylabel, fontsize=Fsize)
+    ax.set_ylabel(ylabel, fontsize=Fsize)
 
     if ylog:
-        plt.yscale('log')
+        ax.set_yscale('log')
 
     if yrange is not None:
-        plt.ylim(yrange)
+        ax.set_ylim(yrange)
 
     if xrange is not None:
-        plt.xlim(xrange)
+        ax.set_xlim(xrange)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if showlinelists is not None:
         for sl, showlinelist in enumerate(showlinelists):
-            ymin, ymax = plt.ylim()
-            xmin, xmax = plt.xlim()
-            for ww, wave in enumerate(showlinelist[:,0]):
-                wave = float(wave)
-                if (wave < xmax) & (wave > xmin):
-                    plt.plot([wave,wave],[ymin,ymax],linestyle='--',color=linelistcolors[sl],lw=lthick)
-                    plt.text(wave,ymin+1.03*np.abs([ymax-ymin]),showlinelist[:,1][ww],color=linelistcolors[sl], fontsize=Fsize-2., ha='center')
+            ymin, ymax = ax.get_ylim()
+            xmin, xmax = ax.get_xlim()
+            waves      = showlinelist[:,0].astype(float)
+            lineents   = np.where((waves < xmax) & (waves > xmin))[0]
+            ax.vlines(waves[lineents],ymin,ymax,linestyle='--',color=linelistcolors[sl],lw=lthick) # one artist for all lines
+            for ww in lineents: # y in axes units; place labels just above the frame
+                ax.text(waves[ww],1.03,showlinelist[ww,1],transform=ax.get_xaxis_transform(),
+                        color=linelistcolors[sl], fontsize=Fsize-2., ha='center')
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if pubversion:
-        leg = plt.legend(fancybox=True, loc='upper center',prop={'size':Fsize-2},ncol=4,numpoints=1,
+        leg = ax.legend(fancybox=True, loc='upper center',prop={'size':Fsize-2},ncol=4,numpoints=1,
                          bbox_to_anchor=(0.44, 1.27))  # add the legend
     else:
-        leg = plt.legend(fancybox=True, loc='upper right',prop={'size':Fsize},ncol=1,numpoints=1,
+        leg = ax.legend(fancybox=True, loc='upper right',prop={'size':Fsize},ncol=1,numpoints=1,
                          bbox_to_anchor=(1.25, 1.03))  # add the legend
 
 
@@ -764,10 +895,12 @@ def plot_1Dspecs(filelist,plotname='./tdose_1Dspectra.pdf',colors=None,labels=No
         plt.show()
     else:
         if verbose: print('   Saving plot to',plotname)
-        plt.savefig(plotname)
+        if plotname.endswith('.pdf'): # drop the time stamp so re-running gives identical PDFs
+            fig.savefig(plotname,metadata={'CreationDate':None})
+        else:
+            fig.savefig(plotname)
 
-    plt.clf()
-    plt.close('all')
+    plt.close(fig)
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def plot_histograms(datavectors,plotname='./tdose_cubehist.pdf',colors=None,labels=None,bins=None,
                     xrange=None,yrange=None,verbose=True,norm=True,ylog=True):
@@ -803,7 +936,7 @@ def plot_histograms(datavectors,plotname='./tdose_cubehist.pdf',colors=None,labe
     fig.subplots_adjust(wspace=0.1, hspace=0.1,left=0.08, right=0.81, bottom=0.1, top=0.95)
     Fsize  = 10
     lthick = 1
-    plt.rc('text', usetex=True)
+    plt.rc('text', usetex=False) # labels are plain text; mathtext avoids a LaTeX run per plot
     plt.rc('font', family='serif',size=Fsize)
     plt.rc('xtick', labelsize=Fsize)
     plt.rc('ytick', labelsize=Fsize)
@@ -812,8 +945,10 @@ def plot_histograms(datavectors,plotname='./tdose_cubehist.pdf',colors=None,labe
     #plt.title(plotname.split('TDOSE 1D spectra'),fontsize=Fsize)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     for dd, datavec in enumerate(datavectors):
-        hist = plt.hist(datavec[~np.isnan(datavec)],color=colors[dd],bins=bins,histtype="step",lw=lthick,
-                        label=labels[dd],normed=norm)
+        counts, binedges = np.histogram(datavec[~np.isnan(datavec)],bins=bins,density=norm)
+        # padding with 0s so the outline is closed down to the baseline at both ends (as histtype='step')
+        plt.step(np.append(binedges[0],binedges),np.concatenate([[0],counts,[0]]),where='post',
+                 color=colors[dd],lw=lthick,label=labels[dd])
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if yrange is None:
         yvals = [1e-5,1e8]
@@ -822,7 +957,7 @@ def plot_histograms(datavectors,plotname='./tdose_cubehist.pdf',colors=None,labe
     plt.plot([0,0],yvals,'--k',lw=lthick)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     plt.xlabel('', fontsize=Fsize)
-    plt.ylabel('\#', fontsize=Fsize)
+    plt.ylabel('#', fontsize=Fsize)
 
     if yrange is not None:
         plt.ylim(yrange)
@@ -838,7 +973,10 @@ def plot_histograms(datavectors,plotname='./tdose_cubehist.pdf',colors=None,labe
     leg.get_frame().set_alpha(0.7)
 
     if verbose: print('   Saving plot to',plotname)
-    plt.savefig(plotname)
+    if plotname.endswith('.pdf'): # drop the time stamp so re-running gives identical PDFs
+        plt.savefig(plotname,metadata={'CreationDate':None})
+    else:
+        plt.savefig(plotname)
     plt.clf()
     plt.close('all')
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
\ No newline at end of file
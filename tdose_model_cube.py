@@ -2,6 +2,7 @@
 import numpy as np
 import os
 import sys
+import multiprocessing
 import astropy.io.fits as afits
 import scipy
 import scipy.ndimage
@@ -19,7 +20,7 @@ import warnings
 def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='gauss',fit_source_scales=True,
                   noisecube=None,psfcube=None,save_modelcube=True,cubename='tdose_model_cube_output_RENAME.fits',clobber=True,
                   outputhdr=None,model_layers=None,optimize_method='matrix',returnresidual=None,verbose=True,
-                  loopverbose=False):
+                  loopverbose=False,Nprocesses=1):
     """
     Generate full model of data cube
 
@@ -61,6 +62,9 @@ def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='
     returnresidual     Provide file name of residual cube (data-model) to return this as well
     verbose            Toggle verbosity
     loopverbose        Toggle verbosity in loop over objects
+    Nprocesses         Number of parallel processes to distribute the modeling of the wavelength layers over.
+                       The layers are modeled independently, so they are split into Nprocesses bundles.
+                       The processes are forked; where that is not possible the layers are modeled serially.
 
     --- EXAMPLE OF USE ---
 
@@ -76,12 +80,8 @@ def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='
             params    = np.reshape(sourceparam,[Nsource,6])
             # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
             if verbose: print(' - Assembling covariance matrixes for '+str(Nsource)+' Gaussian source in parameter list')
-            mu_objs   = np.zeros([Nsource,2])
-            cov_objs  = np.zeros([Nsource,2,2])
-            for nn in np.arange(int(Nsource)):
-                mu_objs[nn,:]    = params[nn][0:2]
-                cov_obj          = tu.build_2D_cov_matrix(params[nn][4],params[nn][3],params[nn][5],verbose=False)
-                cov_objs[nn,:,:] = cov_obj
+            mu_objs   = np.array(params[:,0:2])
+            cov_objs  = tu.build_2D_cov_matrix_batch(params[:,4],params[:,3],params[:,5])
         elif paramtype == 'modelimg':
             if len(sourceparam.shape) == 3:
                 Nsource = sourceparam.shape[0]
@@ -92,7 +92,7 @@ def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='
         if verbose: print(' - Looping over '+str(datashape[0])+' wavelength layers, convolve sources with')
         if verbose: print('   Gaussian PSF and optimize flux scaling for each of them.')
         layer_scales   = np.zeros([Nsource,datashape[0]])
-        model_cube_out = np.zeros(datashape)
+        model_cube_out = np.zeros(datashape,dtype=np.float32) # model stored in single precision like the data cubes
 
         if noisecube is None:
             if verbose: ' - WARNING No sqrt(variance) cube provide for the data cube so using a ' \
@@ -116,230 +116,249 @@ def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='
         else:
             analytic_conv = False
 
-        for ll in layerlist:
-            if verbose:
-                infostr = '   Matching layer '+str("%6.f" % (ll+1))+' / '+str("%6.f" % datashape[0])+''
-                sys.stdout.write("%s\r" % infostr)
-                sys.stdout.flush()
+        if fit_source_scales: # locating non-finite pixels in data and noise cubes once for all layers
+            invalid_mask_cube = ~(np.isfinite(datacube) & np.isfinite(noisecube))
+            invalid_layers    = invalid_mask_cube.reshape(datashape[0],-1).any(axis=1)
+
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        def layer_worker(layers):
+            """
+            Model the wavelength layers with the provided entries in layers
+            """
+            # arrays re-used (overwritten) for every layer
+            noise_ones = np.ones(datashape[1:])
+            if ('matrix' in optimize_method_list) or ('lstsq' in optimize_method_list) or ('nnls' in optimize_method_list):
+                Atrans = np.empty([Nsource,datashape[1]*datashape[2]]) # array to store the noise-weighted source models
+                invnoise = np.empty(datashape[1:]) # array to store the inverse noise of the layer
+                conv_source_images = np.empty([Nsource]+list(datashape[1:])) # array to store the convolved source images
+                psfparam_prev      = None # Gaussian PSF of the sources in conv_source_images; re-used if next layer has same PSF
+
+            for ll in layers:
+                if verbose:
+                    infostr = '   Matching layer '+str("%6.f" % (ll+1))+' / '+str("%6.f" % datashape[0])+''
+                    sys.stdout.write("%s\r" % infostr)
+                    sys.stdout.flush()
 
-            if psfparamtype == 'gauss':
-                mu_psf    = psfparam[ll][0:2]
-                cov_psf   = tu.build_2D_cov_matrix(psfparam[ll][4],psfparam[ll][3],psfparam[ll][5],verbose=loopverbose)
-            elif (psfparamtype == 'kernel_gauss') or (psfparamtype == 'kernel_moffat'):
-                sys.exit('PSF types "kernel* are unfortunately not enabled ')
-            else:
-                sys.exit(' ---> PSF parameter type "'+psfparamtype+'" not enabled')
-
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            if analytic_conv:
-                if verbose & (ll==0): print(' - Performing analytic convolution of Gaussian sources; Build convolved covariance matrixes')
-                mu_objs_conv   = np.zeros([Nsource,2])
-                cov_objs_conv  = np.zeros([Nsource,2,2])
-                for nn in np.arange(int(Nsource)):
-                    muconv, covarconv     = tu.analytic_convolution_gaussian(mu_objs[nn,:],cov_objs[nn,:,:],mu_psf,cov_psf)
-                    mu_objs_conv[nn,:]    = muconv
-                    cov_objs_conv[nn,:,:] = covarconv
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            else:
-                if verbose & (ll==0): print(' - Performing numerical convolution of sources in-loop')
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            if loopverbose: print(' - Build layer image')
-
-            if fit_source_scales:
-                if loopverbose: print(' - Checking if any pixels need to be masked out ')
-                if ( len(np.where(np.isfinite(datacube[ll,:,:].ravel()) == True )[0]) != len(datacube[ll,:,:].ravel()) ) or \
-                        ( len(np.where(np.isfinite(noisecube[ll,:,:].ravel()) == True )[0]) != len(noisecube[ll,:,:].ravel()) ):
-                    if loopverbose: print('   Found non-finite values in cubes so generating mask to ignore those in modeling ')
-                    invalid_mask1   = np.ma.masked_invalid(datacube[ll,:,:]).mask
-                    invalid_mask2   = np.ma.masked_invalid(noisecube[ll,:,:]).mask
-                    comb_mask       = (invalid_mask1 | invalid_mask2)
-
-                    datacube_layer  = np.ma.array(datacube[ll,:,:],mask=comb_mask)
-                    noisecube_layer = np.ma.array(noisecube[ll,:,:],mask=comb_mask)
-
-                    if ('curvefit' in optimize_method_list) or ('nnls' in optimize_method_list) or ('lstsq' in optimize_method_list):
-                        # filling masked arrays with 0s and 1s as curve_fit and nnls can't handle masked arrays
-                        # The np.asarray_chkfinite(datacube_layer) used to check for NaNs returns an error despite the array being masked.
-                        if verbose & (ll==0): print(' - WARNING: NaNs and Infs replaced with 0s (1s) in data (noise) cube, respectively')
-                        if verbose & (ll==0): print('            as masked arrays are not supported by the optimizer "'+str(optimize_method)+'"')
-                        datacube_layer  = datacube_layer.filled(fill_value=0.0)
-                        noisecube_layer = noisecube_layer.filled(fill_value=1.0)
-                else:
-                    comb_mask       = None
-                    datacube_layer  = datacube[ll,:,:]
-                    noisecube_layer = noisecube[ll,:,:]
-
-                #-------------------------------------------------------------------------------------------------------
-                if ('curvefit' in optimize_method_list) & (analytic_conv == True):
-                    if loopverbose: print(' - Optimize flux scaling of each source in full image numerically ')
-                    scalesCFIT, covsCFIT  = tmc.optimize_source_scale_gauss(datacube_layer,
-                                                                            np.ones(datashape[1:]), # noise always ones
-                                                                            mu_objs_conv,cov_objs_conv,
-                                                                            optimizer='curve_fit',verbose=loopverbose)
-
-                    output_layerCFIT      = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
-                                                          sourcescale=scalesCFIT,verbose=loopverbose)
-
-                    output_layer   = output_layerCFIT
-                    output_scales  = scalesCFIT
-                #-------------------------------------------------------------------------------------------------------
-                if ('matrix' in optimize_method_list) or ('lstsq' in optimize_method_list) or ('nnls' in optimize_method_list):
-                    if loopverbose: print(' - Optimize flux scaling of each source in full image analytically ')
-                    if analytic_conv:
-                        if loopverbose: print('   Generating PSFed model convolving model Gaussians analytically ')
-                    else:
-                        if loopverbose: print('   Generating PSFed model convolving model Gaussians numerically with "'+\
-                                              psfparamtype+'" kernel')
-                        if loopverbose: print('   (Before scaling to flux in layer, model will be normalized, i.e. np.sum(model) = 1)')
+                if fit_source_scales:
+                    if not np.any(datacube[ll,:,:][~invalid_mask_cube[ll,:,:]]):
+                        if loopverbose: print(' - All pixels in layer are masked or 0; setting scales and model to 0 ')
+                        layer_scales[:,ll]     = 0.0
+                        model_cube_out[ll,:,:] = 0.0
+                        continue
 
-                    conv_source_images = np.zeros(sourceparam.shape) # array to store the convolved source images
+                if psfparamtype == 'gauss':
+                    mu_psf    = psfparam[ll][0:2]
+                    cov_psf   = tu.build_2D_cov_matrix(psfparam[ll][4],psfparam[ll][3],psfparam[ll][5],verbose=loopverbose)
+                elif (psfparamtype == 'kernel_gauss') or (psfparamtype == 'kernel_moffat'):
+                    sys.exit('PSF types "kernel* are unfortunately not enabled ')
+                else:
+                    sys.exit(' ---> PSF parameter type "'+psfparamtype+'" not enabled')
 
-                    for ss in np.arange(int(Nsource)):
-                        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                if analytic_conv:
+                    if verbose & (ll==0): print(' - Performing analytic convolution of Gaussian sources; Build convolved covariance matrixes')
+                    mu_objs_conv, cov_objs_conv = tu.analytic_convolution_gaussian(mu_objs,cov_objs,np.asarray(mu_psf),
+                                                                                   np.asarray(cov_psf)) # all sources at once
+                # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                else:
+                    if verbose & (ll==0): print(' - Performing numerical convolution of sources in-loop')
+                # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                if loopverbose: print(' - Build layer image')
+
+                if fit_source_scales:
+                    if loopverbose: print(' - Checking if any pixels need to be masked out ')
+                    if invalid_layers[ll]:
+                        if loopverbose: print('   Found non-finite values in cubes so generating mask to ignore those in modeling ')
+                        comb_mask       = invalid_mask_cube[ll,:,:]
+
+                        # filling masked pixels with 0s and 1s in one pass instead of building masked arrays; the masked
+                        # pixels are furthermore ignored (zeroed) in the matrix, lstsq and nnls optimizations below
+                        if verbose & (ll==0): print(' - WARNING: NaNs and Infs replaced with 0s (1s) in data (noise) cube, respectively')
+                        datacube_layer  = np.where(comb_mask,0.0,datacube[ll,:,:])
+                        noisecube_layer = np.where(comb_mask,1.0,noisecube[ll,:,:])
+                    else:
+                        comb_mask       = None
+                        datacube_layer  = datacube[ll,:,:]
+                        noisecube_layer = noisecube[ll,:,:]
+
+                    #-------------------------------------------------------------------------------------------------------
+                    if ('curvefit' in optimize_method_list) & (analytic_conv == True):
+                        if loopverbose: print(' - Optimize flux scaling of each source in full image numerically ')
+                        scalesCFIT, covsCFIT  = tmc.optimize_source_scale_gauss(datacube_layer,
+                                                                                noise_ones, # noise always ones
+                                                                                mu_objs_conv,cov_objs_conv,
+                                                                                optimizer='curve_fit',verbose=loopverbose)
+
+                        output_layerCFIT      = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
+                                                              sourcescale=scalesCFIT,verbose=loopverbose)
+
+                        output_layer   = output_layerCFIT
+                        output_scales  = scalesCFIT
+                    #-------------------------------------------------------------------------------------------------------
+                    if ('matrix' in optimize_method_list) or ('lstsq' in optimize_method_list) or ('nnls' in optimize_method_list):
+                        if loopverbose: print(' - Optimize flux scaling of each source in full image analytically ')
                         if analytic_conv:
-                            img_model  = tmc.gen_image(datashape[1:],mu_objs_conv[ss],cov_objs_conv[ss],sourcescale=[1.0],
-                                                       verbose=False)
-                        else:
-                            img_psf    = psfcube[ll,:,:]
-                            convkernel = img_psf
-
-                            if paramtype == 'modelimg':
-                                if len(sourceparam.shape) == 3:
-                                    inputmodel = sourceparam[ss,:,:]
-                                else:
-                                    inputmodel = sourceparam
-                            else:
-                                sys.exit(' ---> Building of model for numerical intergration is not enabled yet')
-
-                            psfedLayername = False #cubename.replace('.fits','_RefImageModelPSFconvolved_PSFparamtype_'+psfparamtype+'.fits')
-
-                            skipnumericalPSFconvolution = False
-                            if skipnumericalPSFconvolution:
-                                img_model   = inputmodel/np.sum(inputmodel)
-                            else:
-                                img_model_init  = tu.numerical_convolution_image(inputmodel,convkernel,saveimg=psfedLayername,
-                                                                                 clobber=clobber,imgmask=comb_mask,
-                                                                                 fill_value=0.0,norm_kernel=True,convolveFFT=False,
-                                                                                 verbose=loopverbose)
-                                img_model  = img_model_init/np.sum(img_model_init)         # normalizing model (component)
-                                conv_source_images[ss,:,:] = img_model
-                        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-                        img_model  = img_model/noisecube_layer
-                        modelravel = img_model.ravel()
-                        if ss == 0:
-                            Atrans = modelravel
+                            if loopverbose: print('   Generating PSFed model convolving model Gaussians analytically ')
                         else:
-                            Atrans = np.ma.vstack([Atrans,modelravel])
-
-                    if Nsource == 1:
-                        Atrans = np.atleast_2d(Atrans)
-
-                    A          = np.ma.transpose(Atrans)
-                    dataravel  = (datacube_layer/noisecube_layer).ravel()
-
-                    #---------------------------------------------------------------------------------------------------
-                    if 'matrix' in optimize_method_list:
-                        if loopverbose: print('   Using matrix algebra for optimization')
-                        ATA        = Atrans.dot(A)
-                        ATd        = Atrans.dot(dataravel)
-
-                        try:
-                            ATAinv     = np.linalg.inv(ATA)
-                        except:
-                            ATAinv     = np.zeros(ATA.shape)
-                        scalesMTX  = ATAinv.dot(ATd)
-
-                        if comb_mask is not None:
-                            scalesMTX.filled(fill_value=0.0) # If individual scales are masked (not finite) set them to 0.0
+                            if loopverbose: print('   Generating PSFed model convolving model Gaussians numerically with "'+\
+                                                  psfparamtype+'" kernel')
+                            if loopverbose: print('   (Before scaling to flux in layer, model will be normalized, i.e. np.sum(model) = 1)')
 
                         if analytic_conv:
-                            output_layerMTX   = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
-                                                              sourcescale=scalesMTX,verbose=loopverbose)
-                        else:
-                            if Nsource == 1:
-                                output_layerMTX   = img_model_init/np.sum(img_model_init) * scalesMTX
+                            if (psfparam_prev is None) or (not np.array_equal(psfparam[ll],psfparam_prev)):
+                                # evaluating all convolved sources in one pass
+                                conv_source_images[:,:,:] = tmc.gen_image_batch(datashape[1:],mu_objs_conv,cov_objs_conv,
+                                                                                cutoff=10.0,verbose=loopverbose) # 10sigma
+                                psfparam_prev = np.array(psfparam[ll])
                             else:
-                                output_layerMTX = np.zeros(datacube.shape[1:])
-                                for component in np.arange(int(len(scalesMTX))):
-                                    output_layerMTX = output_layerMTX + conv_source_images[component,:,:] * scalesMTX[component]
-                        output_layer   = output_layerMTX
-                        output_scales  = scalesMTX
-
-                    #---------------------------------------------------------------------------------------------------
-                    if 'nnls' in optimize_method_list:
-                        if loopverbose: print('   Using scipy nnls (non-negative least squares) for optimization')
-                        scalesNNLS, residualNNLS = scipy.optimize.nnls(A,dataravel)
-
-                        if analytic_conv:
-                            output_layerNNLS   = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
-                                                              sourcescale=scalesNNLS,verbose=loopverbose)
+                                if loopverbose: print('   PSF identical to previous layer; re-using the convolved sources')
                         else:
-                            if Nsource == 1:
-                                output_layerNNLS   = img_model_init/np.sum(img_model_init) * scalesNNLS
+                            if paramtype == 'modelimg':
+                                inputmodels = np.reshape(sourceparam,[Nsource]+list(datashape[1:]))
                             else:
-                                output_layerNNLS = np.zeros(datacube.shape[1:])
-                                for component in np.arange(int(len(scalesNNLS))):
-                                    output_layerNNLS = output_layerNNLS + sourceparam[component,:,:] * scalesNNLS[component]
-
-                        output_layer   = output_layerNNLS
-                        output_scales  = scalesNNLS
-
-                    #---------------------------------------------------------------------------------------------------
-                    if 'lstsq' in optimize_method_list:
-                        if loopverbose: print('   Using scipy.linalg.lstsq() for optimization')
-                        LSQout     = scipy.linalg.lstsq(A,dataravel)
-                        scalesLSQ  = LSQout[0]
+                                sys.exit(' ---> Building of model for numerical intergration is not enabled yet')
 
-                        if analytic_conv:
-                            output_layerLSQ  = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
-                                                             sourcescale=scalesLSQ,verbose=loopverbose)
-                        else:
-                            output_layerLSQ   = img_model * scalesLSQ
-
-                        output_layer   = output_layerLSQ
-                        output_scales  = scalesLSQ
-                #-------------------------------------------------------------------------------------------------------
-                if optimize_method == 'all':
-                    resCFIT    = (datacube_layer-output_layerCFIT).ravel()
-                    resMTX     = (datacube_layer-output_layerMTX).ravel()
-                    resLSQ     = (datacube_layer-output_layerLSQ).ravel()
-                    resNNLS    = (datacube_layer-output_layerNNLS).ravel()
-
-                    medianCFIT = np.median(resCFIT)
-                    medianMTX  = np.median(resMTX)
-                    medianLSQ  = np.median(resLSQ)
-                    medianNNLS = np.median(resNNLS)
-
-                    meanCFIT   = np.mean(resCFIT)
-                    meanMTX    = np.mean(resMTX)
-                    meanLSQ    = np.mean(resLSQ)
-                    meanNNLS   = np.mean(resNNLS)
-
-                    import pylab as plt
-                    plt.hist(resCFIT,label='dat-CFITmodel (med='+str("%.2f" % medianCFIT)+', mea='+str("%.2f" % meanCFIT)+')',
-                             bins=50,alpha=0.3)
-                    plt.hist(resMTX,label='dat-MTXmodel (med='+str("%.2f" % medianMTX)+', mea='+str("%.2f" % meanMTX)+')',
-                             bins=50,alpha=0.3)
-                    plt.hist(resLSQ,label='dat-LSQmodel (med='+str("%.2f" % medianLSQ)+', mea='+str("%.2f" % meanLSQ)+')',
-                             bins=50,alpha=0.3)
-                    plt.hist(resNNLS,label='dat-NNLSmodel (med='+str("%.2f" % medianNNLS)+', mea='+str("%.2f" % meanNNLS)+')',
-                             bins=50,alpha=0.3)
-                    plt.legend()
-                    plt.show()
-
-                    print(' ---> Stopping in gen_fullmodel() for further investigation')
-                    pdb.set_trace()
-            else:
-                if loopverbose: print(' - Optimize flux scaling of full image numerically ')
-                layer_img      = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
-                                               sourcescale=params[:,2],verbose=loopverbose)
-                scale, cov     = tmc.optimize_img_scale(datacube[ll,:,:],noisecube[ll,:,:],layer_img,
-                                                        verbose=loopverbose)
-                output_layer   = layer_img * scale
-                output_scales  = np.asarray(scale.tolist * Nsource)
-
-            layer_scales[:,ll]     = output_scales
-            model_cube_out[ll,:,:] = output_layer
+                            # convolving all sources at once so the layer PSF is only prepared and transformed once
+                            conv_inputmodels = tu.numerical_convolution_imagestack(inputmodels,psfcube[ll,:,:],imgmask=comb_mask,
+                                                                                   fill_value=0.0,norm_kernel=True,
+                                                                                   workers=(-1 if Nprocesses <= 1 else 1),
+                                                                                   verbose=loopverbose)
+
+                        np.divide(1.0,noisecube_layer,out=invnoise) # weighting with multiplications instead of divisions
+                        for ss in range(int(Nsource)):
+                            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                            if not analytic_conv:
+                                img_model_init = conv_inputmodels[ss,:,:]
+                                if np.sum(img_model_init) != 0: # normalizing model (component); all 0s in fully masked layers
+                                    conv_source_images[ss,:,:] = img_model_init/np.sum(img_model_init)
+                                else:
+                                    conv_source_images[ss,:,:] = img_model_init
+                            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+                            np.multiply(conv_source_images[ss,:,:],invnoise,out=Atrans[ss,:].reshape(datashape[1:]))
+
+                        dataravel  = (datacube_layer*invnoise).ravel()
+                        if comb_mask is not None: # ignoring masked pixels by zeroing them in the model and data vectors
+                            maskravel = comb_mask.ravel()
+                            Atrans[:,maskravel] = 0.0
+                            dataravel[maskravel] = 0.0
+
+                        A          = Atrans.T
+                        if ('matrix' in optimize_method_list) or ('nnls' in optimize_method_list):
+                            ATA        = Atrans.dot(A)
+                            ATd        = Atrans.dot(dataravel)
+
+                        #---------------------------------------------------------------------------------------------------
+                        if 'matrix' in optimize_method_list:
+                            if loopverbose: print('   Using matrix algebra for optimization')
+                            try: # ATA is symmetric positive definite for independent sources; solve via its Cholesky factor
+                                ATAchol    = scipy.linalg.cho_factor(ATA,check_finite=False)
+                                scalesMTX  = scipy.linalg.cho_solve(ATAchol,ATd,check_finite=False)
+                            except np.linalg.LinAlgError: # singular ATA, e.g., fully masked layer
+                                scalesMTX  = scipy.linalg.lstsq(ATA,ATd)[0]
+
+                            if comb_mask is not None:
+                                scalesMTX[~np.isfinite(scalesMTX)] = 0.0 # If individual scales are not finite set them to 0.0
+
+                            output_layerMTX = np.tensordot(scalesMTX,conv_source_images,axes=1) # sum of scaled sources
+                            output_layer   = output_layerMTX
+                            output_scales  = scalesMTX
+
+                        #---------------------------------------------------------------------------------------------------
+                        if 'nnls' in optimize_method_list:
+                            if loopverbose: print('   Using scipy nnls (non-negative least squares) for optimization')
+                            try: # with ATA = U^T U: |Ax-d|^2 = |Ux-U^-T ATd|^2 + const., i.e., an Nsource x Nsource NNLS problem
+                                ATAupper   = scipy.linalg.cholesky(ATA,check_finite=False)
+                                Ud         = scipy.linalg.solve_triangular(ATAupper,ATd,trans='T',check_finite=False)
+                                scalesNNLS, residualNNLS = scipy.optimize.nnls(ATAupper,Ud)
+                            except np.linalg.LinAlgError: # singular ATA; solve the full (Npix x Nsource) problem
+                                scalesNNLS, residualNNLS = scipy.optimize.nnls(A,dataravel)
+
+                            output_layerNNLS = np.tensordot(scalesNNLS,conv_source_images,axes=1) # sum of scaled sources
+
+                            output_layer   = output_layerNNLS
+                            output_scales  = scalesNNLS
+
+                        #---------------------------------------------------------------------------------------------------
+                        if 'lstsq' in optimize_method_list:
+                            if loopverbose: print('   Using scipy.linalg.lstsq() for optimization')
+                            LSQout     = scipy.linalg.lstsq(A,dataravel,lapack_driver='gelsy',check_finite=False) # A is finite after masking
+                            scalesLSQ  = LSQout[0]
+
+                            output_layerLSQ = np.tensordot(scalesLSQ,conv_source_images,axes=1) # sum of scaled sources
+
+                            output_layer   = output_layerLSQ
+                            output_scales  = scalesLSQ
+                    #-------------------------------------------------------------------------------------------------------
+                    if (optimize_method == 'all') & (Nprocesses <= 1): # interactive comparison; not in forked processes
+                        resCFIT    = (datacube_layer-output_layerCFIT).ravel()
+                        resMTX     = (datacube_layer-output_layerMTX).ravel()
+                        resLSQ     = (datacube_layer-output_layerLSQ).ravel()
+                        resNNLS    = (datacube_layer-output_layerNNLS).ravel()
+
+                        medianCFIT = np.median(resCFIT)
+                        medianMTX  = np.median(resMTX)
+                        medianLSQ  = np.median(resLSQ)
+                        medianNNLS = np.median(resNNLS)
+
+                        meanCFIT   = np.mean(resCFIT)
+                        meanMTX    = np.mean(resMTX)
+                        meanLSQ    = np.mean(resLSQ)
+                        meanNNLS   = np.mean(resNNLS)
+
+                        import pylab as plt
+                        plt.hist(resCFIT,label='dat-CFITmodel (med='+str("%.2f" % medianCFIT)+', mea='+str("%.2f" % meanCFIT)+')',
+                                 bins=50,alpha=0.3)
+                        plt.hist(resMTX,label='dat-MTXmodel (med='+str("%.2f" % medianMTX)+', mea='+str("%.2f" % meanMTX)+')',
+                                 bins=50,alpha=0.3)
+                        plt.hist(resLSQ,label='dat-LSQmodel (med='+str("%.2f" % medianLSQ)+', mea='+str("%.2f" % meanLSQ)+')',
+                                 bins=50,alpha=0.3)
+                        plt.hist(resNNLS,label='dat-NNLSmodel (med='+str("%.2f" % medianNNLS)+', mea='+str("%.2f" % meanNNLS)+')',
+                                 bins=50,alpha=0.3)
+                        plt.legend()
+                        plt.show()
+
+                        print(' ---> Stopping in gen_fullmodel() for further investigation')
+                        pdb.set_trace()
+                else:
+                    if loopverbose: print(' - Optimize flux scaling of full image numerically ')
+                    layer_img      = tmc.gen_image(datashape[1:],mu_objs_conv,cov_objs_conv,
+                                                   sourcescale=params[:,2],verbose=loopverbose)
+                    scale, cov     = tmc.optimize_img_scale(datacube[ll,:,:],noisecube[ll,:,:],layer_img,
+                                                            verbose=loopverbose)
+                    output_layer   = layer_img * scale
+                    output_scales  = np.asarray(scale.tolist * Nsource)
+
+                layer_scales[:,ll]     = output_scales
+                model_cube_out[ll,:,:] = output_layer
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        Nprocesses = int(np.min([Nprocesses,len(layerlist)]))
+        if (Nprocesses > 1) & ('fork' not in multiprocessing.get_all_start_methods()):
+            if verbose: print(' - WARNING: Processes can not be forked on this platform; modeling the layers in a single process')
+            Nprocesses = 1
+        if (Nprocesses > 1) & (optimize_method == 'all'):
+            if verbose: print(' - WARNING: optimize_method = "all" comparison (and stop) is only done when Nprocesses = 1')
+
+        if Nprocesses <= 1:
+            layer_worker(layerlist)
+        else:
+            if verbose: print(' - Distributing modeling of the '+str(len(layerlist))+' layers over '+str(Nprocesses)+' processes')
+            # forking the processes (independent of the default start method) so they inherit layer_worker and
+            # the input cubes; output arrays are placed in shared memory so the modeled layers end up in them
+            forkcontext    = multiprocessing.get_context('fork')
+            layer_scales   = np.frombuffer(forkcontext.RawArray('d',layer_scales.size)).reshape(layer_scales.shape)
+            model_cube_out = np.frombuffer(forkcontext.RawArray('f',model_cube_out.size),dtype=np.float32).reshape(datashape)
+            jobs = []
+            for pp, layers in enumerate(np.array_split(layerlist,Nprocesses)):
+                job = forkcontext.Process(target=layer_worker,args=(layers,),name='layermodelNo'+str(pp+1))
+                jobs.append(job)
+                job.start()
+
+            for job in jobs:
+                job.join()
+
+            failedjobs = [job.name for job in jobs if job.exitcode != 0]
+            if len(failedjobs) > 0:
+                sys.exit(' ---> The layer modeling processes '+str(failedjobs)+' did not finish successfully')
         if verbose: print('\n   ----------- Finished on '+tu.get_now_string()+' ----------- ')
     elif paramtype == 'aperture':
         if verbose: print('   ----------- Started on '+tu.get_now_string()+' ----------- ')
@@ -358,8 +377,14 @@ def gen_fullmodel(datacube,sourceparam,psfparam,paramtype='gauss',psfparamtype='
         tmc.save_cube(cubename,model_cube_out,layer_scales,outputhdr=outputhdr,clobber=clobber,verbose=verbose)
 
         if returnresidual is not None:
-            residualcube = datacube - model_cube_out
-            tmc.save_cube(returnresidual,residualcube,layer_scales,outputhdr=outputhdr,clobber=clobber,verbose=verbose)
+            # writing the model to the residual file and subtracting it from the data layer by layer in the
+            # memory mapped file, so no cube-sized residual array is kept in memory
+            tmc.save_cube(returnresidual,model_cube_out,layer_scales,outputhdr=outputhdr,clobber=clobber,verbose=verbose)
+            if verbose: print(' - Subtracting model from data cube to get residual cube ')
+            with afits.open(returnresidual,mode='update',memmap=True) as residualhdul:
+                residualcube = residualhdul[len(residualhdul)-2].data # the cube is followed by the layer scale extension
+                for ll in np.arange(int(datashape[0])):
+                    residualcube[ll,:,:] = datacube[ll,:,:] - residualcube[ll,:,:]
 
     return model_cube_out, layer_scales
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -382,31 +407,31 @@ def save_cube(cubename,datacube,layer_scales,outputhdr=None,clobber=False,verbos
         hducube = afits.PrimaryHDU(datacube)       # default HDU with default minimal header
         if verbose: print(' - No header provided so will generate one ')
         # writing hdrkeys:    '---KEY--',                       '----------------MAX LENGTH COMMENT-------------'
-        hducube.header.append(('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),end=True)
-        hducube.header.append(('OBJECT '                      ,'model_cube'),end=True)
-        hducube.header.append(('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),end=True)
-        hducube.header.append(('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),end=True)
-        hducube.header.append(('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD1_2  ',                   0.,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD2_1  ',                   0.,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),end=True)
-        hducube.header.append(('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-        hducube.header.append(('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-        hducube.header.append(('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),end=True)
-        hducube.header.append(('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),end=True)
-        hducube.header.append(('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),end=True)
-        hducube.header.append(('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),end=True)
-        hducube.header.append(('CRVAL1 ',          53.1078417 ,' '),end=True)
-        hducube.header.append(('CRVAL2 ',         -27.8267356 ,' '),end=True)
-        hducube.header.append(('CTYPE3 ','AWAV    '           ,' '),end=True)
-        hducube.header.append(('CUNIT3 ','Angstrom'           ,' '),end=True)
-        hducube.header.append(('CD3_3  ',                1.25 ,' '),end=True)
-        hducube.header.append(('CRPIX3 ',                  1. ,' '),end=True)
-        hducube.header.append(('CRVAL3 ',    4800             ,' '),end=True)
-        hducube.header.append(('CD1_3  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD2_3  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD3_1  ',                  0. ,' '),end=True)
-        hducube.header.append(('CD3_2  ',                  0. ,' '),end=True)
+        hducube.header.extend([('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),
+                               ('OBJECT '                      ,'model_cube'),
+                               ('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),
+                               ('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),
+                               ('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),
+                               ('CD1_2  ',                   0.,' Coordinate transformation matrix element'),
+                               ('CD2_1  ',                   0.,' Coordinate transformation matrix element'),
+                               ('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),
+                               ('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),
+                               ('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),
+                               ('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),
+                               ('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),
+                               ('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),
+                               ('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),
+                               ('CRVAL1 ',          53.1078417 ,' '),
+                               ('CRVAL2 ',         -27.8267356 ,' '),
+                               ('CTYPE3 ','AWAV    '           ,' '),
+                               ('CUNIT3 ','Angstrom'           ,' '),
+                               ('CD3_3  ',                1.25 ,' '),
+                               ('CRPIX3 ',                  1. ,' '),
+                               ('CRVAL3 ',    4800             ,' '),
+                               ('CD1_3  ',                  0. ,' '),
+                               ('CD2_3  ',                  0. ,' '),
+                               ('CD3_1  ',                  0. ,' '),
+                               ('CD3_2  ',                  0. ,' ')],end=True)
 
         hdus = [hducube]
     else:
@@ -421,19 +446,19 @@ def save_cube(cubename,datacube,layer_scales,outputhdr=None,clobber=False,verbos
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     hduscales = afits.ImageHDU(layer_scales)       # default HDU with default minimal header
     # writing hdrkeys:       '---KEY--',                      '----------------MAX LENGTH COMMENT-------------'
-    hduscales.header.append(('EXTNAME ','WAVESCL'            ,' None'),end=True)
-    hduscales.header.append(('BUNIT   '                      ,' None'),end=True)
-    hduscales.header.append(('OBJECT  '                      ,' layer_scales'),end=True)
-    hduscales.header.append(('CRPIX1  ',                   99,' '),end=True)
-    hduscales.header.append(('CRVAL1  ',                   99,' '),end=True)
-    hduscales.header.append(('CDELT1  ',                 1.25,' '),end=True)
-    hduscales.header.append(('CUNIT1  ', 'Angstrom',' '),end=True)
-    hduscales.header.append(('CTYPE1  ', 'WAVE    ',' '),end=True)
-    hduscales.header.append(('CRPIX2  ',                  0.0,' '),end=True)
-    hduscales.header.append(('CRVAL2  ',                    0,' '),end=True)
-    hduscales.header.append(('CDELT2  ',                  1.0,' '),end=True)
-    hduscales.header.append(('CUNIT2  ', 'Number  ',' '),end=True)
-    hduscales.header.append(('CTYPE2  ', 'SOURCE  ',' '),end=True)
+    hduscales.header.extend([('EXTNAME ','WAVESCL'            ,' None'),
+                             ('BUNIT   '                      ,' None'),
+                             ('OBJECT  '                      ,' layer_scales'),
+                             ('CRPIX1  ',                   99,' '),
+                             ('CRVAL1  ',                   99,' '),
+                             ('CDELT1  ',                 1.25,' '),
+                             ('CUNIT1  ', 'Angstrom',' '),
+                             ('CTYPE1  ', 'WAVE    ',' '),
+                             ('CRPIX2  ',                  0.0,' '),
+                             ('CRVAL2  ',                    0,' '),
+                             ('CDELT2  ',                  1.0,' '),
+                             ('CUNIT2  ', 'Number  ',' '),
+                             ('CTYPE2  ', 'SOURCE  ',' ')],end=True)
 
     hduscales.header['CRPIX1'] = hducube.header['CRPIX3']
     hduscales.header['CRVAL1'] = hducube.header['CRVAL3']
@@ -454,7 +479,12 @@ def optimize_source_scale_gauss(img_data,img_std,mu_objs,cov_objs,optimizer='cur
     img_std         Standard deviation image for data to use in optimization
     mu_objs         Mean vectors for multivariate Gaussian sources to scale         Dimensions: [Nobj,2]
     cov_objs        Covariance matrixes for multivariate Gaussian sources to scale. Dimensions: [Nobj,2,2]
-    optimizer       The optimizer to use when scaling the sources
+    optimizer       The optimizer to use when scaling the sources. Choose between:
+                        curve_fit   Unconstrained fit with scipy.optimize.curve_fit()
+                        nnls        Non-negative linear least squares solution (scipy.optimize.nnls)
+                        lstsq       Unconstrained linear least squares solution (scipy.linalg.lstsq)
+                    For all optimizers the returned covariance is scaled by the reduced chi2 of the fit
+                    (as for curve_fit's default absolute_sigma=False)
     verbose         Toggle verbosity
 
     --- EXAMPLE OF USE ---
@@ -470,16 +500,39 @@ def optimize_source_scale_gauss(img_data,img_std,mu_objs,cov_objs,optimizer='cur
     if optimizer == 'leastsq':
         sys.exit('optimizer = "leastsq" not enabled')
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    elif optimizer in ['nnls','lstsq']:
+        # the model is linear in the scales, so solve the weighted linear system directly
+        imgsize                = img_data.shape
+        weights                = 1.0/img_std.ravel()
+        source_basis_w         = np.reshape(tmc.gen_image_batch(imgsize,mu_objs,cov_objs,cutoff=10.0,verbose=False),
+                                            [mu_objs.shape[0],-1]).T * weights[:,None]
+        data_w                 = img_data.ravel() * weights
+        if optimizer == 'nnls':
+            scale_best, rnorm  = opt.nnls(source_basis_w,data_w)
+        else:
+            scale_best         = scipy.linalg.lstsq(source_basis_w,data_w,lapack_driver='gelsy',check_finite=False)[0]
+        scale_cov              = np.linalg.pinv(source_basis_w.T.dot(source_basis_w))
+        # scaling the covariance by the reduced chi2 as curve_fit (absolute_sigma=False) and optimize_img_scale()
+        Ndof                   = len(data_w) - len(scale_best)
+        if Ndof > 0:
+            chi2               = np.sum((source_basis_w.dot(scale_best) - data_w)**2)
+            scale_cov          = scale_cov * chi2/Ndof
+        else:
+            scale_cov          = np.full(scale_cov.shape,np.inf)
+        output = scale_best, scale_cov
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     elif optimizer == 'curve_fit':
         scales_initial_guess   = np.ones(mu_objs.shape[0])
         imgsize                = img_data.shape
-        xgrid, ygrid           = tu.gen_gridcomponents(imgsize)
+        # the model is linear in the scales, so the unit-scale source images make up the (constant) Jacobian.
+        # As the model does not depend on the pixel grid, no (xgrid,ygrid) is passed to (and copied by) curve_fit
+        source_basis           = np.reshape(tmc.gen_image_batch(imgsize,mu_objs,cov_objs,cutoff=10.0,verbose=False),
+                                            [len(scales_initial_guess),-1]).T
         with warnings.catch_warnings():
             #warnings.simplefilter("ignore")
-            scale_best, scale_cov  = opt.curve_fit(lambda xgrid, ygrid, *scales:
-                                                   curve_fit_fct_wrapper_sourcefit((xgrid, ygrid),mu_objs,
-                                                                                   cov_objs,*scales),(xgrid, ygrid),
-                                                   img_data.ravel(), p0 = scales_initial_guess, sigma=img_std.ravel() )
+            scale_best, scale_cov  = opt.curve_fit(lambda xygrid, *scales: source_basis.dot(scales),np.empty(0),
+                                                   img_data.ravel(), p0 = scales_initial_guess, sigma=img_std.ravel(),
+                                                   jac=lambda xygrid, *scales: source_basis, check_finite=False)
         output = scale_best, scale_cov
     else:
         sys.exit(' ---> Invalid optimizer ('+optimizer+') chosen for optimize_source_scale_gauss()')
@@ -512,12 +565,19 @@ def optimize_img_scale(img_data,img_std,img_model,optimizer='curve_fit',show_res
         sys.exit('optimizer = "leastsq" no enabled')
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     elif optimizer == 'curve_fit':
-        imgsize                = img_data.shape
-        xgrid, ygrid           = tu.gen_gridcomponents(imgsize)
-        scale_best, scale_cov  = opt.curve_fit(lambda xgrid, ygrid, scale:
-                                               tmc.curve_fit_fct_wrapper_imgscale((xgrid, ygrid), scale, img_model),
-                                               (xgrid, ygrid),
-                                               img_data.ravel(), p0 = [1.0], sigma=img_std.ravel() )
+        # the model is linear in the scale, so the weighted least squares problem solved by
+        # opt.curve_fit() has the closed form solution scale = sum(m*d/std**2) / sum(m*m/std**2)
+        weights    = 1.0/img_std.ravel()**2
+        modelravel = img_model.ravel()
+        dataravel  = img_data.ravel()
+        mTm        = np.einsum('i,i,i->',modelravel,modelravel,weights)
+        if mTm == 0:
+            if verbose: print(' - WARNING: Model image is all 0s so the scale is undetermined; returning scale = 0')
+            scale_best, scale_cov = np.array([0.0]), np.array([[np.inf]])
+        else:
+            scale_best = np.array([np.einsum('i,i,i->',modelravel,dataravel,weights) / mTm])
+            chi2       = np.sum(weights*(dataravel-scale_best[0]*modelravel)**2)
+            scale_cov  = np.array([[chi2/(len(dataravel)-1.0) / mTm]]) # covariance scaled by reduced chi2 as curve_fit
 
         output = scale_best, scale_cov
     else:
@@ -544,7 +604,10 @@ def curve_fit_fct_wrapper_sourcefit(xygrid,mu_objs,cov_objs,*scales):
     Wrapper for curve_fit optimizer function
     """
     (x,y) = xygrid
-    imagedim  = x.shape
+    if np.ndim(x) == 2:
+        imagedim = x.shape
+    else: # 1D pixel axes provided instead of full grids
+        imagedim = (np.size(y),np.size(x))
     scls      = np.asarray(scales)
     img_model = tmc.gen_image(imagedim,mu_objs,cov_objs,sourcescale=scls,verbose=False)
 
@@ -554,12 +617,11 @@ def curve_fit_fct_wrapper_imgscale(xygrid,scale,img_model):
     """
     Wrapper for curve_fit optimizer function
     """
-    (x,y) = xygrid
     img_scaled = img_model*scale
 
     return img_scaled.ravel()
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-def gen_image(imagedim,mu_objs,cov_objs,sourcescale='ones',verbose=True):
+def gen_image(imagedim,mu_objs,cov_objs,sourcescale='ones',out=None,verbose=True):
     """
     Performing analytic convolution of multiple  guassian sources with a single gaussian PSF in image (layer)
 
@@ -568,6 +630,7 @@ def gen_image(imagedim,mu_objs,cov_objs,sourcescale='ones',verbose=True):
     mu_objs         The mean values for each source to convolve in an (Nobj,2) array
     cov_objs        The covariance matrixes for the infividual sources in an (Nobj,2,2) array
     sourcescale     Scale to aply to sources. Default is one scaling, i.e., sourcesclae = [1]*Nobj
+    out             Array (of shape imagedim) to write the output image to instead of allocating a new one
     verbose         Toggle verbosity
 
     --- EXAMPLE OF USE ---
@@ -575,65 +638,79 @@ def gen_image(imagedim,mu_objs,cov_objs,sourcescale='ones',verbose=True):
     img_conv = tmc.gen_image()
 
     """
-    sourcescale = list(sourcescale) # convert source scales to list to prevent "Future warning" when comparing to 'ones'
-    img_out   = np.zeros(imagedim)
-    if mu_objs.shape == (2,):
-        Nmu       = 1
-    else:
-        Nmu       = mu_objs.shape[0]
+    if verbose: print(' - Generating the sources (evaluated at their positions) and adding them to output image')
+    img_out = np.sum(tmc.gen_image_batch(imagedim,mu_objs,cov_objs,sourcescale=sourcescale,cutoff=10.0, # 10sigma
+                                         verbose=verbose),axis=0,out=out)
 
-    if cov_objs.shape == (2, 2):
-        Ncov      = 1
-    else:
-        Ncov      = cov_objs.shape[0]
-
-    if Nmu != Ncov:
-        sys.exit(' ---> Number of mu-vectors ('+str(Nmu)+') and covariance matrixes ('+str(Ncov)+
-                 ') does not agree in gen_image()')
-    else:
-        Nobj  = Nmu
-
-    if sourcescale == 'ones':
-        if verbose: print(' - Setting all source flux scales to 1.')
-        scalings = [1]*Nobj
-    else:
-        if verbose: print(' - Applying user-defined source scalings provided with "sourcescale".')
-        scalings = sourcescale
-
-    for oo in np.arange(int(Nobj)):
-        if Nobj == 1: # only one object
-            if len(mu_objs.shape) == 2:
-                muconv = mu_objs[oo,:]
-            else:
-                muconv = mu_objs[:]
+    return img_out
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def gen_image_batch(imagedim,mu_objs,cov_objs,sourcescale='ones',cutoff=None,verbose=True):
+    """
+    Evaluating multiple 2D gaussian sources on the pixel grid of an image (layer) in one vectorized pass.
+    In contrast to gen_image(), which returns the sum of the sources, the sources are returned individually.
 
-            if len(cov_objs.shape) == 3:
-                covarconv = cov_objs[oo,:,:]
-            else:
-                covarconv = cov_objs[:,:]
-        else:
-            muconv, covarconv = mu_objs[oo,:], cov_objs[oo,:,:]
+    --- INPUT ---
+    imagedim        Image dimensions of output to contain the sources
+    mu_objs         The mean values (1-based pixel positions) for each source in an (Nobj,2) array
+    cov_objs        The covariance matrixes for the individual sources in an (Nobj,2,2) array
+    sourcescale     Scale to apply to sources. Default is one scaling, i.e., sourcescale = [1]*Nobj
+    cutoff          If provided, each source is only evaluated within the box enclosing its cutoff-sigma ellipse
+                    and set to 0 outside of it. Speeds up the evaluation of compact sources in large images.
+    verbose         Toggle verbosity
 
-        if verbose: print(' - Generating source in spatial dimensions ')
-        try:
-            source_centered = tu.gen_2Dgauss(imagedim,covarconv,scalings[oo],show2Dgauss=False,verbose=verbose)
-        except:
-            print(' - ERROR: Something went wrong in tdose_model_cube.gen_image(); stopping to further investigate...')
-            pdb.set_trace()
+    --- EXAMPLE OF USE ---
+    import tdose_model_cube as tmc
+    cov_objs = tu.build_2D_cov_matrix_batch(np.array([2.0,1.5]),np.array([1.0,1.5]),np.array([30.0,0.0]))
+    imgs     = tmc.gen_image_batch([31,41],np.array([[10.3,12.7],[20.0,30.0]]),cov_objs)
+    img_sum  = np.sum(imgs,axis=0)
 
-        if verbose: print(' - Positioning source at position according to mu-vector (x,y) = ('+\
-                      str(muconv[1])+','+str(muconv[0])+') in output image')
-        #source_positioned = tu.roll_2Dprofile(source_centered,muconv,showprofiles=False)
-        source_positioned = tu.shift_2Dprofile(source_centered,muconv,showprofiles=False,origin=1)
+    """
+    mu_objs  = np.reshape(np.asarray(mu_objs,dtype=float),[-1,2])
+    cov_objs = np.reshape(np.asarray(cov_objs,dtype=float),[-1,2,2])
+    Nobj     = mu_objs.shape[0]
 
-        if verbose: print(' - Adding convolved source to output image')
-        img_out  = img_out + source_positioned
+    if Nobj != cov_objs.shape[0]:
+        sys.exit(' ---> Number of mu-vectors ('+str(Nobj)+') and covariance matrixes ('+str(cov_objs.shape[0])+
+                 ') does not agree in gen_image_batch()')
 
-    return img_out
+    if isinstance(sourcescale,str) and (sourcescale == 'ones'):
+        if verbose: print(' - Setting all source flux scales to 1.')
+        scalings = np.ones(Nobj)
+    else:
+        if verbose: print(' - Applying user-defined source scalings provided with "sourcescale".')
+        scalings = np.asarray(sourcescale,dtype=float)
+
+    if verbose: print(' - Evaluating the '+str(Nobj)+' sources on the '+str(imagedim)+' pixel grid')
+    cyy   = cov_objs[:,0,0][:,None,None]
+    cxx   = cov_objs[:,1,1][:,None,None]
+    cyx   = (cov_objs[:,0,1]+cov_objs[:,1,0])[:,None,None]
+    det   = cyy*cxx - cov_objs[:,0,1][:,None,None]*cov_objs[:,1,0][:,None,None]
+    norm  = scalings[:,None,None] / (2.0 * np.pi * np.sqrt(det))
+
+    yy    = (np.arange(imagedim[0])[None,:] - (mu_objs[:,0:1]-1.0))[:,:,None] # pixel offsets from source centers
+    xx    = (np.arange(imagedim[1])[None,:] - (mu_objs[:,1:2]-1.0))[:,None,:]
+
+    if cutoff is None:
+        quad  = (cxx*yy*yy - cyx*yy*xx + cyy*xx*xx) / det
+        return norm * np.exp(-0.5*quad)
+
+    imgs  = np.zeros([Nobj]+list(imagedim))
+    ymin  = np.clip(np.floor(mu_objs[:,0]-1.0-cutoff*np.sqrt(cov_objs[:,0,0])),0,imagedim[0]).astype(int)
+    ymax  = np.clip(np.ceil(mu_objs[:,0]-1.0+cutoff*np.sqrt(cov_objs[:,0,0]))+1,0,imagedim[0]).astype(int)
+    xmin  = np.clip(np.floor(mu_objs[:,1]-1.0-cutoff*np.sqrt(cov_objs[:,1,1])),0,imagedim[1]).astype(int)
+    xmax  = np.clip(np.ceil(mu_objs[:,1]-1.0+cutoff*np.sqrt(cov_objs[:,1,1]))+1,0,imagedim[1]).astype(int)
+    for oo in range(int(Nobj)):
+        ybox  = yy[oo,ymin[oo]:ymax[oo],:]
+        xbox  = xx[oo,:,xmin[oo]:xmax[oo]]
+        quad  = (cxx[oo]*ybox*ybox - cyx[oo]*ybox*xbox + cyy[oo]*xbox*xbox) / det[oo]
+        imgs[oo,ymin[oo]:ymax[oo],xmin[oo]:xmax[oo]] = norm[oo] * np.exp(-0.5*quad)
+
+    return imgs
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def gen_source_model_cube(layer_scales,cubeshape,sourceparam,psfparam,paramtype='gauss',psfparamtype='gauss',
                           psfcube=False,save_modelcube=True,cubename='tdose_source_model_cube_output_RENAME.fits',
-                          clobber=True,outputhdr='None',verbose=True):
+                          clobber=True,outputhdr='None',Nprocesses=1,dtype=np.float32,use_memmap=False,
+                          verbose=True):
     """
     Generate 4D cube with dimensions [Nobj,Nlayes,ydim,xdim] containing the source models
     for each source making up the model cube generated with gen_fullmodel()
@@ -662,63 +739,86 @@ def gen_source_model_cube(layer_scales,cubeshape,sourceparam,psfparam,paramtype=
     cubename        Name of fits file to save model cube to
     clobber         If true any existing fits file will be overwritten
     outputhdr       Header to use for output fits file. If none provided a default header will be used.
+    Nprocesses      Number of processes to distribute the generation of the layers of the 'gauss' and
+                    'modelimg' source models over. Default is 1, i.e., no parallelization.
+                    The processes are forked; where that is not possible the layers are generated serially.
+    dtype           Data type of the output source model cube. Default is single precision (np.float32)
+                    which halves the memory footprint and size of the output fits file compared to np.float64
+    use_memmap      If true (and save_modelcube=True) the source model cube is not kept in memory but generated
+                    in a memory mapped file (cubename+'.raw'), which is removed again once the fits file is written.
+                    The returned cube is then the memory mapped data of the saved fits file. Allows generating
+                    source model cubes larger than the available memory.
     verbose         Toggle verbosity
 
     --- EXAMPLE OF USE ---
 
 
     """
-    Nlayers = layer_scales.shape[1]
+    Nlayers      = layer_scales.shape[1]
+    progressstep = int(np.max([1,Nlayers//100])) # only reporting progress for every progressstep'th layer
+    use_memmap   = use_memmap & save_modelcube
+    memmapname   = cubename+'.raw'
+
+    def allocate_out_cube(Nsource):
+        """
+        Allocate the (zero-filled) output source model cube either in memory or as a memory mapped file
+        """
+        if use_memmap:
+            if verbose: print(' - Generating the source model cube in the memory mapped file '+memmapname)
+            return np.memmap(memmapname,dtype=dtype,mode='w+',shape=(Nsource,cubeshape[0],cubeshape[1],cubeshape[2]))
+        else:
+            return np.zeros([Nsource,cubeshape[0],cubeshape[1],cubeshape[2]],dtype=dtype)
 
     if paramtype == 'gauss':
         if verbose: print(' - Set up output source model cube based on Gaussian parameters and sub-cube input shape  ')
         Nsource   = int(len(sourceparam)/6.0)
         params    = np.reshape(sourceparam,[Nsource,6])
 
-        out_cube  = np.zeros([Nsource,cubeshape[0],cubeshape[1],cubeshape[2]])
+        out_cube  = allocate_out_cube(Nsource)
 
-        if verbose: print(' - Loop over sources and layers to fill output cube with data ')
-        if verbose: print('   ----------- Started on '+tu.get_now_string()+' ----------- ')
-        for ss in np.arange(int(Nsource)):
-            for ll in np.arange(int(Nlayers)):
-                if verbose:
+        if psfparamtype == 'gauss': # building mean vectors and covariance matrices of PSFs and sources once
+            psfparam  = np.asarray(psfparam)
+            mu_psfs   = psfparam[:,0:2]
+            cov_psfs  = tu.build_2D_cov_matrix_batch(psfparam[:,4],psfparam[:,3],psfparam[:,5])
+        else:
+            sys.exit(' ---> PSF parameter type "'+psfparamtype+'" not enabled')
+        mu_objs   = params[:,0:2]
+        cov_objs  = tu.build_2D_cov_matrix_batch(params[:,4],params[:,3],params[:,5])
+
+        def layer_worker(layers):
+            """
+            Generate the source models for the wavelength layers with the provided entries in layers
+            """
+            for ll in layers:
+                if verbose & (ll % progressstep == 0):
                     infostr = '   Generating layer '+str("%6.f" % (ll+1))+' / '+str("%6.f" % cubeshape[0])+\
-                              ' in source cube '+str("%6.f" % (ss+1))+' / '+str("%6.f" % Nsource)
+                              ' in all '+str("%6.f" % Nsource)+' source cubes'
                     sys.stdout.write("%s\r" % infostr)
                     sys.stdout.flush()
 
-                if psfparamtype == 'gauss':
-                    mu_psf    = psfparam[ll][0:2]
-                    cov_psf   = tu.build_2D_cov_matrix(psfparam[ll][4],psfparam[ll][3],psfparam[ll][5],verbose=False)
-                else:
-                    sys.exit(' ---> PSF parameter type "'+psfparamtype+'" not enabled')
-
-                mu_obj               = params[ss][0:2]
-                cov_obj              = tu.build_2D_cov_matrix(params[ss][4],params[ss][3],params[ss][5],verbose=False)
-                mu_conv, cov_conv    = tu.analytic_convolution_gaussian(mu_obj,cov_obj,mu_psf,cov_psf)
-                layer_img            = tmc.gen_image(cubeshape[1:],np.asarray([mu_conv]),np.asarray([cov_conv]),
-                                                     sourcescale=[1.0],verbose=False)
-                out_cube[ss,ll,:,:]  = layer_img * layer_scales[ss,ll]
-        if verbose: print('\n   ----------- Finished on '+tu.get_now_string()+' ----------- ')
+                for ss in range(int(Nsource)):
+                    mu_conv, cov_conv = tu.analytic_convolution_gaussian(mu_objs[ss],cov_objs[ss],mu_psfs[ll],cov_psfs[ll])
+                    tmc.gen_image(cubeshape[1:],mu_conv,cov_conv,sourcescale=[layer_scales[ss,ll]],out=out_cube[ss,ll,:,:],
+                                  verbose=False)
     elif paramtype == 'aperture':
         if verbose: print(' - Set up output source model cube based on aperture parameters and sub-cube input shape  ')
         Nsource      = int(len(sourceparam)/4.0)
         params       = np.reshape(sourceparam,[Nsource,4])
-        out_cube     = np.zeros([Nsource,cubeshape[0],cubeshape[1],cubeshape[2]])
+        out_cube     = allocate_out_cube(Nsource)
         xgrid, ygrid = tu.gen_gridcomponents(cubeshape[1:])
 
         if verbose: print(' - Loop over sources and layers to fill output cube with data ')
         if verbose: print('   ----------- Started on '+tu.get_now_string()+' ----------- ')
         for ss in np.arange(int(Nsource)):
-            for ll in np.arange(int(Nlayers)):
-                if verbose:
-                    infostr = '   Generating layer '+str("%6.f" % (ll+1))+' / '+str("%6.f" % cubeshape[0])+\
-                              ' in source cube '+str("%6.f" % (ss+1))+' / '+str("%6.f" % Nsource)
-                    sys.stdout.write("%s\r" % infostr)
-                    sys.stdout.flush()
+            if verbose:
+                infostr = '   Generating all '+str("%6.f" % Nlayers)+' layers in source cube '+str("%6.f" % (ss+1))+' / '+\
+                          str("%6.f" % Nsource)
+                sys.stdout.write("%s\r" % infostr)
+                sys.stdout.flush()
 
-                layer_img           = tmf.modelimage_aperture((xgrid,ygrid), params[ss], showmodelimg=False, verbose=False)
-                out_cube[ss,ll,:,:] = layer_img * layer_scales[ss,ll]
+            # the aperture model is the same in all layers, so it is generated once and scaled for each layer
+            layer_img           = tmf.modelimage_aperture((xgrid,ygrid), params[ss], showmodelimg=False, verbose=False)
+            np.multiply(layer_img[np.newaxis,:,:],layer_scales[ss,:,np.newaxis,np.newaxis],out=out_cube[ss,:Nlayers,:,:])
         if verbose: print('\n   ----------- Finished on '+tu.get_now_string()+' ----------- ')
 
     elif paramtype == 'modelimg':
@@ -731,37 +831,63 @@ def gen_source_model_cube(layer_scales,cubeshape,sourceparam,psfparam,paramtype=
         else:
             sys.exit(' ---> Shape of model data array is not 2 (image) or 3 (cube) ')
 
-        out_cube  = np.zeros([Nsource,cubeshape[0],cubeshape[1],cubeshape[2]])
+        out_cube    = allocate_out_cube(Nsource)
+        inputmodels = np.reshape(sourceparam,[Nsource,cubeshape[1],cubeshape[2]])
 
-        if verbose: print(' - Loop over layers to fill output cube with data ')
-        if verbose: print('   ----------- Started on '+tu.get_now_string()+' ----------- ')
-        for ss in np.arange(int(Nsource)):
-            for ll in np.arange(int(Nlayers)):
-                if verbose:
+        def layer_worker(layers):
+            """
+            Generate the source models for the wavelength layers with the provided entries in layers
+            """
+            for ll in layers:
+                if verbose & (ll % progressstep == 0):
                     infostr = '   Generating layer '+str("%6.f" % (ll+1))+' / '+str("%6.f" % cubeshape[0])+\
-                              ' in source cube '+str("%6.f" % (ss+1))+' / '+str("%6.f" % Nsource)
+                              ' in all '+str("%6.f" % Nsource)+' source cubes'
                     sys.stdout.write("%s\r" % infostr)
                     sys.stdout.flush()
 
-                img_psf    = psfcube[ll,:,:]
-                convkernel = img_psf
+                # convolving all sources at once so the layer PSF is only prepared and transformed once
+                conv_models = tu.numerical_convolution_imagestack(inputmodels,psfcube[ll,:,:],imgmask=None,fill_value=0.0,
+                                                                  norm_kernel=True,workers=(-1 if Nprocesses <= 1 else 1),
+                                                                  verbose=False)
+                # normalizing the convolved models (np.sum(model) = 1) before scaling them to the flux in the layer.
+                # The sum is taken over the convolved models as flux convolved beyond the image edges is lost.
+                np.multiply(conv_models,(layer_scales[:,ll]/np.sum(conv_models,axis=(1,2)))[:,None,None],
+                            out=out_cube[:,ll,:,:])
+    else:
+        sys.exit(' ---> Invalid parameter type ('+paramtype+') provided to gen_source_model_cube()')
 
-                if len(sourceparam.shape) == 3:
-                    inputmodel = sourceparam[ss,:,:]
-                else:
-                    inputmodel = sourceparam
+    if paramtype in ['gauss','modelimg']:
+        if verbose: print(' - Loop over layers and sources to fill output cube with data ')
+        if verbose: print('   ----------- Started on '+tu.get_now_string()+' ----------- ')
+        Nprocesses = int(np.min([Nprocesses,Nlayers]))
+        if (Nprocesses > 1) & ('fork' not in multiprocessing.get_all_start_methods()):
+            if verbose: print(' - WARNING: Processes can not be forked on this platform; generating the layers in a single process')
+            Nprocesses = 1
 
-                skipnumericalPSFconvolution = False
-                if skipnumericalPSFconvolution:
-                    layer_img       = inputmodel/np.sum(inputmodel)
-                else:
-                    img_model_init  = tu.numerical_convolution_image(inputmodel,convkernel,saveimg=False,clobber=clobber,imgmask=None,
-                                                                     fill_value=0.0,norm_kernel=True,convolveFFT=False,verbose=False)
-                    layer_img            = img_model_init/np.sum(img_model_init)
-                out_cube[ss,ll,:,:]  = layer_img * layer_scales[ss,ll]
+        if Nprocesses <= 1:
+            layer_worker(np.arange(int(Nlayers)))
+        else:
+            if verbose: print(' - Distributing generation of the '+str(Nlayers)+' layers over '+str(Nprocesses)+' processes')
+            # forking the processes (independent of the default start method) so they inherit layer_worker
+            forkcontext = multiprocessing.get_context('fork')
+            if not use_memmap: # memory mapped files are already shared between the processes
+                # output cube is placed in shared memory so the layers generated by the processes end up in it
+                out_cube = np.frombuffer(forkcontext.RawArray(np.ctypeslib.as_ctypes_type(out_cube.dtype),
+                                                                  out_cube.size),
+                                         dtype=out_cube.dtype).reshape(out_cube.shape)
+            jobs = []
+            for pp, layers in enumerate(np.array_split(np.arange(int(Nlayers)),Nprocesses)):
+                job = forkcontext.Process(target=layer_worker,args=(layers,),name='layergenNo'+str(pp+1))
+                jobs.append(job)
+                job.start()
+
+            for job in jobs:
+                job.join()
+
+            failedjobs = [job.name for job in jobs if job.exitcode != 0]
+            if len(failedjobs) > 0:
+                sys.exit(' ---> The source model generating processes '+str(failedjobs)+' did not finish successfully')
         if verbose: print('\n   ----------- Finished on '+tu.get_now_string()+' ----------- ')
-    else:
-        sys.exit(' ---> Invalid parameter type ('+paramtype+') provided to gen_source_model_cube()')
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if save_modelcube:
         if verbose: print('\n - Saving source model cube to \n   '+cubename)
@@ -769,33 +895,33 @@ def gen_source_model_cube(layer_scales,cubeshape,sourceparam,psfparam,paramtype=
         if outputhdr == 'None':
             if verbose: print(' - No header provided so will generate one ')
             # writing hdrkeys:    '---KEY--',                       '----------------MAX LENGTH COMMENT-------------'
-            hducube.header.append(('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),end=True)
-            hducube.header.append(('OBJECT '                      ,'mock_cube'),end=True)
-            hducube.header.append(('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),end=True)
-            hducube.header.append(('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),end=True)
-            hducube.header.append(('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),end=True)
-            hducube.header.append(('CD1_2  ',                  0.,' Coordinate transformation matrix element'),end=True)
-            hducube.header.append(('CD2_1  ',                  0. ,' Coordinate transformation matrix element'),end=True)
-            hducube.header.append(('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),end=True)
-            hducube.header.append(('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-            hducube.header.append(('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),end=True)
-            hducube.header.append(('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),end=True)
-            hducube.header.append(('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),end=True)
-            hducube.header.append(('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),end=True)
-            hducube.header.append(('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),end=True)
-            hducube.header.append(('CRVAL1 ',          53.1078417 ,' '),end=True)
-            hducube.header.append(('CRVAL2 ',         -27.8267356 ,' '),end=True)
-            hducube.header.append(('CTYPE3 ','AWAV    '           ,' '),end=True)
-            hducube.header.append(('CUNIT3 ','Angstrom'           ,' '),end=True)
-            hducube.header.append(('CD3_3  ',                1.25 ,' '),end=True)
-            hducube.header.append(('CRPIX3 ',                  1. ,' '),end=True)
-            hducube.header.append(('CRVAL3 ',    4800             ,' '),end=True)
-            hducube.header.append(('CD1_3  ',                  0. ,' '),end=True)
-            hducube.header.append(('CD2_3  ',                  0. ,' '),end=True)
-            hducube.header.append(('CD3_1  ',                  0. ,' '),end=True)
-            hducube.header.append(('CD3_2  ',                  0. ,' '),end=True)
-            hducube.header.append(('CTYPE4 ','SOURCE  '           ,' '),end=True)
-            hducube.header.append(('CUNIT4 ','Number  '           ,' '),end=True)
+            hducube.header.extend([('BUNIT  '                      ,'(10**(-20)*erg/s/cm**2/Angstrom)**2'),
+                                   ('OBJECT '                      ,'mock_cube'),
+                                   ('CRPIX1 ',    201.043514357863 ,' Pixel coordinate of reference point'),
+                                   ('CRPIX2 ',    201.629151352493 ,' Pixel coordinate of reference point'),
+                                   ('CD1_1  ',-5.55555555555556E-05,' Coordinate transformation matrix element'),
+                                   ('CD1_2  ',                  0.,' Coordinate transformation matrix element'),
+                                   ('CD2_1  ',                  0. ,' Coordinate transformation matrix element'),
+                                   ('CD2_2  ',5.55555555555556E-05 ,' Coordinate transformation matrix element'),
+                                   ('CUNIT1 ','deg     '           ,' Units of coordinate increment and value'),
+                                   ('CUNIT2 ','deg     '           ,' Units of coordinate increment and value'),
+                                   ('CTYPE1 ','RA---TAN'           ,' Right ascension, gnomonic projection'),
+                                   ('CTYPE2 ','DEC--TAN'           ,' Declination, gnomonic projection'),
+                                   ('CSYER1 ',   1.50464086916E-05 ,' [deg] Systematic error in coordinate'),
+                                   ('CSYER2 ',   6.61226954775E-06 ,' [deg] Systematic error in coordinate'),
+                                   ('CRVAL1 ',          53.1078417 ,' '),
+                                   ('CRVAL2 ',         -27.8267356 ,' '),
+                                   ('CTYPE3 ','AWAV    '           ,' '),
+                                   ('CUNIT3 ','Angstrom'           ,' '),
+                                   ('CD3_3  ',                1.25 ,' '),
+                                   ('CRPIX3 ',                  1. ,' '),
+                                   ('CRVAL3 ',    4800             ,' '),
+                                   ('CD1_3  ',                  0. ,' '),
+                                   ('CD2_3  ',                  0. ,' '),
+                                   ('CD3_1  ',                  0. ,' '),
+                                   ('CD3_2  ',                  0. ,' '),
+                                   ('CTYPE4 ','SOURCE  '           ,' '),
+                                   ('CUNIT4 ','Number  '           ,' ')],end=True)
 
             hdus = [hducube]
         else:
@@ -812,7 +938,18 @@ def gen_source_model_cube(layer_scales,cubeshape,sourceparam,psfparam,paramtype=
             # hducube.header = outputhdr
 
         hdulist = afits.HDUList(hdus)       # turn header into to hdulist
-        hdulist.writeto(cubename,overwrite=clobber)  # write fits file
+        try:
+            hdulist.writeto(cubename,overwrite=clobber)  # write fits file
+        finally:
+            if use_memmap: # the scratch file is removed also if writing the fits file fails
+                if verbose: print(' - Removing '+memmapname)
+                del hdulist, hdus, hducube, out_cube
+                os.remove(memmapname)
+
+        if use_memmap:
+            if verbose: print(' - Returning memory mapped data of '+cubename)
+            with afits.open(cubename,memmap=True) as cubehdul: # memory map stays valid after the file is closed
+                out_cube = cubehdul[-1].data
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
     return out_cube
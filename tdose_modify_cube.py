@@ -1,6 +1,7 @@
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 import numpy as np
 import sys
+import multiprocessing
 import astropy.io.fits as fits
 import tdose_utilities as tu
 import tdose_modify_cube as tmc
@@ -25,42 +26,38 @@ def perform_modification(setupfile='./tdose_setup_template_modify.txt',clobber=F
 
     """
 
-    start_time = time.clock()
+    start_time = time.perf_counter()
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print('==================================================================================================')
     if verbose: print(' TDOSE: Loading setup                                       '+\
-                      '      ( Total runtime = '+str("%10.4f" % (time.clock() - start_time))+' seconds )')
+                      '      ( Total runtime = '+str("%10.4f" % (time.perf_counter() - start_time))+' seconds )')
 
     setupdic        = tu.load_setup(setupfile,verbose=verbose)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print('==================================================================================================')
     if verbose: print(' TDOSE: Logging setup                                       '+\
-                      '      ( Total runtime = '+str("%10.4f" % (time.clock() - start_time))+' seconds )')
+                      '      ( Total runtime = '+str("%10.4f" % (time.perf_counter() - start_time))+' seconds )')
 
     setuplog = setupdic['modified_cube_dir']+setupfile.split('/')[-1].replace('.txt','_logged.txt')
     if os.path.isfile(setuplog) & (clobber == False):
         if verbose: print(' - WARNING Logged setupfile exists and clobber = False. Not storing setup ')
     else:
         if verbose: print(' - Writing setup and command to spec1D_directory to log extraction setup and command that was run')
-        setupinfo    = open(setupfile,'r')
-        setupcontent = setupinfo.read()
-        setupinfo.close()
+        with open(setupfile,'r') as setupinfo:
+            setupcontent = setupinfo.read()
 
         cmdthatwasrun = "import tdose_modify_cube as tmc; tmc.perform_modification(setupfile='%s',clobber=%s,verbose=%s)" % \
                         (setuplog,clobber,verbose)
 
-        loginfo = open(setuplog, 'w')
-        loginfo.write("# The setup file appended below was run with the command: \n# "+cmdthatwasrun+
-                      " \n# on "+tu.get_now_string()+'\n# ')
-
-        loginfo.write(setupcontent)
-        loginfo.close()
+        with open(setuplog, 'w') as loginfo: # writing command info and setup in one go
+            loginfo.write("# The setup file appended below was run with the command: \n# "+cmdthatwasrun+
+                          " \n# on "+tu.get_now_string()+'\n# '+setupcontent)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     if verbose: print('==================================================================================================')
     if verbose: print(' TDOSE: Modifying data cube                                 '+\
-                      '      ( Total runtime = '+str("%10.4f" % (time.clock() - start_time))+' seconds )')
+                      '      ( Total runtime = '+str("%10.4f" % (time.perf_counter() - start_time))+' seconds )')
 
     savestring = 'satelitesremoved'
 
@@ -80,7 +77,7 @@ def perform_modification(setupfile='./tdose_setup_template_modify.txt',clobber=F
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def remove_object(datacube,sourcemodelcube,objects=[1,3],remove=True,dataext=1,sourcemodelext=1,
-                  savecube=False,savedir=None,clobber=False,verbose=True):
+                  savecube=False,savedir=None,clobber=False,Nprocesses=1,verbose=True):
     """
     Use source model cube to remove object(s) from data cube
 
@@ -98,6 +95,9 @@ def remove_object(datacube,sourcemodelcube,objects=[1,3],remove=True,dataext=1,s
     savedir             If a directory path is provided, the modified cube will be stored here. Otherwise
                         it will be stored at the same location as the datacube.
     clobber             If true any existing fits file will be overwritten if modified cube is saved
+    Nprocesses          Number of processes to distribute the subtraction of the models over. Each process
+                        handles a consecutive chunk of wavelength layers. Default is 1, i.e., no parallelization.
+                        The processes are forked; where that is not possible the cube is modified serially.
     verbose             Toggle verbosity
 
     --- EXAMPLE OF USE ---
@@ -110,21 +110,19 @@ def remove_object(datacube,sourcemodelcube,objects=[1,3],remove=True,dataext=1,s
 
 
     """
-    if verbose: print(' - Loading data and source model cubes ')
-    datacubehdu     = fits.open(datacube)
+    if verbose: print(' - Loading data and source model cubes (memory mapped) ')
+    datacubehdu     = fits.open(datacube, memmap=True, mode='readonly')
     dataarr         = datacubehdu[dataext].data
     dataarr_hdr     = datacubehdu[dataext].header
 
-    sourcemodelhdu  = fits.open(sourcemodelcube)
-    sourcemodel     = sourcemodelhdu[sourcemodelext].data
+    sourcemodelhdu  = fits.open(sourcemodelcube, memmap=True, mode='readonly')
+    sourcemodel     = sourcemodelhdu[sourcemodelext].section # only the indexed models are read from the file
     sourcemodel_hdr = sourcemodelhdu[sourcemodelext].header
-    sourcemodelhdu.close()
 
-    Nmodels         = sourcemodel.shape[0]
-    models          = np.arange(Nmodels)
+    Nmodels         = sourcemodelhdu[sourcemodelext].shape[0]
 
     if verbose: print(' - Check that all objects indicated are present in source model cube')
-    objects  = np.asarray(objects)
+    objects  = np.asarray(objects,dtype=np.intp) # casting object indexes once
 
     maxobj = np.max(np.abs(objects))
     if maxobj >= Nmodels:
@@ -133,16 +131,70 @@ def remove_object(datacube,sourcemodelcube,objects=[1,3],remove=True,dataext=1,s
         if verbose: print(('   All object models appear to be included in the '+str(Nmodels)+' source models found in cube'))
 
     if verbose: print(' - Determining objects (source models) to remove from data cube ')
+    objmask          = np.zeros(Nmodels,dtype=bool) # flagging the objects; cheaper than np.setdiff1d (no sorting)
+    objmask[objects] = True
     if remove:
-        obj_remove = objects
-        obj_keep   = np.setdiff1d(models,obj_remove)
+        obj_remove = np.sort(objects) # ascending model order reads the source model file sequentially
+        obj_keep   = np.nonzero(~objmask)[0]
     else:
         obj_keep   = objects
-        obj_remove = np.setdiff1d(models,obj_keep)
-
-    remove_cube = np.sum(sourcemodel[obj_remove.astype(int),:,:,:],axis=0)
+        obj_remove = np.nonzero(~objmask)[0]
 
-    modified_cube = dataarr - remove_cube
+    # subtracting the source models one by one from a single copy of the data cube, so neither a summed
+    # cube of the removed models nor the full source model cube is ever held in memory
+    if np.issubdtype(dataarr.dtype,np.floating): # keeping the precision of the data cube, e.g., no float64 upcast of
+        cubedtype = dataarr.dtype.newbyteorder('=') # float32 cubes by float64 models; models are cast on subtraction
+    else:
+        modeldtype = sourcemodel[0,0,0,0:1].dtype # reading a single pixel to get the data type of the models
+        cubedtype  = np.result_type(dataarr.dtype,modeldtype)
+    modified_cube = np.empty(dataarr.shape,dtype=cubedtype)
+
+    # processing the cube in slabs of wavelength layers (~8MB) so each slab stays in cache while all models are
+    # subtracted from it, i.e., the data cube is only passed through once
+    slabsize      = int(np.max([1,(8*1024**2)//modified_cube[0].nbytes]))
+
+    def slab_worker(layers):
+        """
+        Subtract the models to remove from the (consecutive) wavelength layers with the provided entries in layers
+        """
+        for ll in np.arange(layers[0],layers[-1]+1,slabsize):
+            lmax          = int(np.min([ll+slabsize,layers[-1]+1]))
+            dataslab      = modified_cube[ll:lmax,:,:]
+            if len(obj_remove) == 0:
+                dataslab[...] = dataarr[ll:lmax,:,:]
+            else: # subtracting the first model while copying the data, i.e., a single pass when removing one model
+                np.subtract(dataarr[ll:lmax,:,:],sourcemodel[obj_remove[0],ll:lmax,:,:],out=dataslab)
+                for oo in obj_remove[1:]:
+                    np.subtract(dataslab,sourcemodel[oo,ll:lmax,:,:],out=dataslab)
+
+    Nlayers    = dataarr.shape[0]
+    Nprocesses = int(np.min([Nprocesses,Nlayers]))
+    if (Nprocesses > 1) & ('fork' not in multiprocessing.get_all_start_methods()):
+        if verbose: print(' - WARNING: Processes can not be forked on this platform; modifying the cube in a single process')
+        Nprocesses = 1
+
+    if Nprocesses <= 1:
+        slab_worker(np.arange(int(Nlayers)))
+    else:
+        if verbose: print(' - Distributing the '+str(Nlayers)+' wavelength layers over '+str(Nprocesses)+' processes')
+        # forking the processes (independent of the default start method) so they inherit slab_worker and the
+        # memory mapped cubes; the modified cube is placed in shared memory so the modified layers end up in it
+        forkcontext   = multiprocessing.get_context('fork')
+        modified_cube = np.frombuffer(forkcontext.RawArray(np.ctypeslib.as_ctypes_type(cubedtype),modified_cube.size),
+                                      dtype=cubedtype).reshape(modified_cube.shape)
+        jobs = []
+        for pp, layers in enumerate(np.array_split(np.arange(int(Nlayers)),Nprocesses)):
+            job = forkcontext.Process(target=slab_worker,args=(layers,),name='layermodifyNo'+str(pp+1))
+            jobs.append(job)
+            job.start()
+
+        for job in jobs:
+            job.join()
+
+        failedjobs = [job.name for job in jobs if job.exitcode != 0]
+        if len(failedjobs) > 0:
+            sys.exit(' ---> The cube modifying processes '+str(failedjobs)+' did not finish successfully')
+    sourcemodelhdu.close()
 
     if savecube:
         datacubehdu[dataext].data = modified_cube # Replacing original data with modified cube
@@ -157,18 +209,23 @@ def remove_object(datacube,sourcemodelcube,objects=[1,3],remove=True,dataext=1,s
         # hducube.header = dataarr_hdr
 
         # adding hdrkeys:   '---KEY--',                       '----------------MAX LENGTH COMMENT-------------'
-        dataarr_hdr.append(('MODIFIED',                'True','Cube is modified with tdose_modify_cube.py?'),end=True)
-        dataarr_hdr.append(('MODTIME ',   tu.get_now_string(),'Date and time of cube modification'),end=True)
-        dataarr_hdr.append(('SMC     ',       sourcemodelcube,'Name of Source Model Cube'),end=True)
-        dataarr_hdr.append(('NREMOVE ',       len(obj_remove),'Number of sources removed from cube'),end=True)
-        dataarr_hdr.append(('NKEEP   ',         len(obj_keep),'Number of sources kept in cube'),end=True)
-        dataarr_hdr.append(('SREMOVE ',','.join([str(oo) for oo in obj_remove])),'Source indexes removed',end=True)
-        dataarr_hdr.append(('SKEEP   ',','.join([str(oo) for oo in obj_keep])),'Source indexes kept',end=True)
+        dataarr_hdr.extend([('MODIFIED',                'True','Cube is modified with tdose_modify_cube.py?'),
+                            ('MODTIME ',   tu.get_now_string(),'Date and time of cube modification'),
+                            ('SMC     ',       sourcemodelcube,'Name of Source Model Cube'),
+                            ('NREMOVE ',       len(obj_remove),'Number of sources removed from cube'),
+                            ('NKEEP   ',         len(obj_keep),'Number of sources kept in cube'),
+                            ('SREMOVE ',','.join([str(oo) for oo in obj_remove]),'Source indexes removed'),
+                            ('SKEEP   ',','.join([str(oo) for oo in obj_keep]),'Source indexes kept')],end=True)
         # dataarr_hdr.append(('COMMENT ','Source indexes removed:'+','.join([str(oo) for oo in obj_remove])),end=True)
         # dataarr_hdr.append(('COMMENT ','Source indexes kept:'+','.join([str(oo) for oo in obj_keep])),end=True)
 
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        datacubehdu.writeto(outname,overwrite=clobber)
+        if os.path.isfile(outname) & (clobber == False):
+            sys.exit(' ---> Output file '+outname+' already exists and clobber = False')
+        # writing through a large (64MB) file buffer so the many small header and padding writes of astropy are
+        # collected in few write calls (the cube data itself is written directly); keeps networked file systems happy
+        with open(outname,'wb',buffering=64*1024**2) as outfile:
+            datacubehdu.writeto(outfile)
 
     return modified_cube
 
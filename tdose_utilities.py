@@ -19,6 +19,7 @@ import glob
 import shutil
 import scipy.ndimage
 import scipy.special
+import scipy.fft
 import scipy.integrate as integrate
 import tdose_utilities as tu
 import tdose_model_FoV as tmf
@@ -462,6 +463,34 @@ def build_2D_cov_matrix(sigmax,sigmay,angle,verbose=True):
 
     return cov_rot
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def build_2D_cov_matrix_batch(sigmax,sigmay,angle):
+    """
+    Build the covariance matrices for a set of 2D multivariate Gaussians in one go.
+    Returns the same as stacking tu.build_2D_cov_matrix(sigmax[nn],sigmay[nn],angle[nn]) for all entries.
+
+    --- INPUT ---
+    sigmax          Standard deviations of the x-compoents of the multivariate Gaussians
+    sigmay          Standard deviations of the y-compoents of the multivariate Gaussians
+    angle           Angles to rotate matrices by in degrees (clockwise) to populate covariance cross terms
+
+    --- EXAMPLE OF USE ---
+    import tdose_utilities as tu
+    covmatrices = tu.build_2D_cov_matrix_batch(np.array([3,2]),np.array([1,1]),np.array([35,0]))
+
+    """
+    sigmax    = np.atleast_1d(np.asarray(sigmax,dtype=float))
+    sigmay    = np.atleast_1d(np.asarray(sigmay,dtype=float))
+    angle_rad = (180.0-np.atleast_1d(np.asarray(angle,dtype=float))) * np.pi/180.0 # same convention as build_2D_cov_matrix
+    c, s      = np.cos(angle_rad), np.sin(angle_rad)
+
+    cov_rot        = np.zeros([len(angle_rad),2,2])  # rot * cov * rot^T written out for all matrices
+    cov_rot[:,0,0] = c**2.0 * sigmay**2.0 + s**2.0 * sigmax**2.0
+    cov_rot[:,1,1] = s**2.0 * sigmay**2.0 + c**2.0 * sigmax**2.0
+    cov_rot[:,0,1] = c * s * (sigmay**2.0 - sigmax**2.0)
+    cov_rot[:,1,0] = cov_rot[:,0,1]
+
+    return cov_rot
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def normalize_2D_cov_matrix(covmatrix,verbose=True):
     """
     Calculate the normalization foctor for a multivariate gaussian from it's covariance matrix
@@ -472,7 +501,8 @@ def normalize_2D_cov_matrix(covmatrix,verbose=True):
     verbose         Toggle verbosity
 
     """
-    detcov  = np.linalg.det(covmatrix)
+    covmatrix = np.asarray(covmatrix)
+    detcov  = covmatrix[0,0]*covmatrix[1,1] - covmatrix[0,1]*covmatrix[1,0] # analytic 2x2 determinant
     normfac = 1.0 / (2.0 * np.pi * np.sqrt(detcov) )
 
     return normfac
@@ -499,7 +529,7 @@ def gen_noisy_cube(cube,type='poisson',gauss_std=0.5,verbose=True):
     if type == 'poisson':
         cube_with_noise = np.random.poisson(lam=cube, size=None)
     elif type == 'gauss':
-        cube_with_noise = cube + np.random.normal(loc=np.zeros(cube.shape),scale=gauss_std, size=None)
+        cube_with_noise = cube + np.random.normal(loc=0.0,scale=gauss_std, size=cube.shape)
     else:
         sys.exit(' ---> type="'+type+'" is not valid in call to mock_cube_sources.generate_cube_noise() ')
 
@@ -595,7 +625,7 @@ def perform_2Dconvolution(cube,kernels,use_fftconvolution=False,verbose=True):
 
     """
     csh = cube.shape
-    cube_convolved = np.zeros(csh)
+    cube_convolved = np.zeros(csh,dtype=cube.dtype)
 
     for zz in np.arange(int(csh[0])): # looping over wavelength layers of cube
         layer = cube[zz,:,:]
@@ -647,7 +677,7 @@ def gen_aperture(imgsize,ypos,xpos,radius,pixval=1,showaperture=False,verbose=Tr
 
     return aperture
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-def gen_2Dgauss(size,cov,scale,method='scipy',show2Dgauss=False,savefits=False,verbose=True):
+def gen_2Dgauss(size,cov,scale,method='analytic',show2Dgauss=False,savefits=False,verbose=True):
     """
     Generating a 2D gaussian with specified parameters
 
@@ -659,6 +689,7 @@ def gen_2Dgauss(size,cov,scale,method='scipy',show2Dgauss=False,savefits=False,v
     scale         Scaling the 2D gaussian. By default scale = 1 returns normalized 2D Gaussian.
                   I.e.,  np.trapz(np.trapz(gauss2D,axis=0),axis=0) = 1
     method        Method to use for generating 2D gaussian:
+                   'analytic' Evaluate the analytic expression of the 2D gaussian PDF with tu.eval_2Dgauss()
                    'scipy'    Using the class multivariate_normal from the scipy.stats library
                    'matrix'   Use direct matrix expression for PDF of 2D gaussian               (slow!)
     show2Dgauss   Save plot of generated 2D gaussian
@@ -684,7 +715,12 @@ def gen_2Dgauss(size,cov,scale,method='scipy',show2Dgauss=False,savefits=False,v
 
     """
     if verbose: print(' - Generating multivariate_normal object for generating 2D gauss using ')
-    if method == 'scipy':
+    if method == 'analytic':
+        if verbose: print(' analytic expression for the PDF (tu.eval_2Dgauss) ')
+        yvec    = np.arange(-np.floor(size[0]/2.),np.ceil(size[0]/2.),1.0)
+        xvec    = np.arange(-np.floor(size[1]/2.),np.ceil(size[1]/2.),1.0)
+        gauss2D = tu.eval_2Dgauss(yvec,xvec,cov,1.0)
+    elif method == 'scipy':
         if verbose: print(' scipy.stats.multivariate_normal.pdf() ')
         mvn     = multivariate_normal([0, 0], cov)
 
@@ -700,10 +736,13 @@ def gen_2Dgauss(size,cov,scale,method='scipy',show2Dgauss=False,savefits=False,v
         gauss2D = np.zeros([np.int(np.ceil(size[0])),np.int(np.ceil(size[1]))])
         mean    = np.array([np.floor(size[0]/2.),np.floor(size[1]/2.)])
         norm    = 1/np.linalg.det(np.sqrt(cov))/2.0/np.pi
+        covarr  = np.asarray(cov)
+        detcov  = covarr[0,0]*covarr[1,1] - covarr[0,1]*covarr[1,0]
+        covinv  = np.array([[covarr[1,1],-covarr[0,1]],[-covarr[1,0],covarr[0,0]]]) / detcov # analytic 2x2 inverse
         for xpix in np.arange(size[1]):
             for ypix in np.arange(size[0]):
                 coordMmean                   = np.array([int(ypix),int(xpix)]) - mean
-                MTXexpr                      = np.dot(np.dot(np.transpose(coordMmean),np.linalg.inv(cov)),coordMmean)
+                MTXexpr                      = np.dot(np.dot(np.transpose(coordMmean),covinv),coordMmean)
                 gauss2D[int(ypix),int(xpix)] = norm * np.exp(-0.5 * MTXexpr)
 
     if float(size[0]/2.) - float(int(size[0]/2.)) == 0.0:
@@ -745,6 +784,41 @@ def gen_2Dgauss(size,cov,scale,method='scipy',show2Dgauss=False,savefits=False,v
         if verbose: print((' - Saved image of shifted profile to '+fitsname))
     return gauss2D
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def eval_2Dgauss(yvec,xvec,cov,scale):
+    """
+    Evaluate the PDF of a 2D gaussian (centered at 0,0) on the grid spanned by the two coordinate vectors.
+    The analytic inverse and determinant of the 2x2 covariance matrix is used, i.e., no
+    scipy.stats.multivariate_normal object or (y,x) position array is built. For axis aligned
+    gaussians (no covariance cross terms) the PDF is evaluated as the product of two 1D gaussians.
+
+    --- INPUT ---
+    yvec          Vector of y coordinates (relative to the center of the gaussian) of the grid
+    xvec          Vector of x coordinates (relative to the center of the gaussian) of the grid
+    cov           Covariance matrix of gaussian, i.e., variances and rotation (in (y,x) order).
+                  Can be build with cov = build_2D_cov_matrix(stdx,stdy,angle)
+    scale         Scaling of the 2D gaussian. scale = 1 returns the normalized 2D Gaussian.
+
+    --- EXAMPLE OF USE ---
+    import tdose_utilities as tu
+    covmatrix   = tu.build_2D_cov_matrix(4,1,5)
+    gauss2Dimg  = tu.eval_2Dgauss(np.arange(-10,10),np.arange(-20,20),covmatrix,5)
+
+    """
+    cov   = np.asarray(cov)
+    det   = cov[0,0]*cov[1,1] - cov[0,1]*cov[1,0]
+    norm  = scale / (2.0 * np.pi * np.sqrt(det))
+
+    yy    = np.asarray(yvec,dtype=float)[:,None]
+    xx    = np.asarray(xvec,dtype=float)[None,:]
+
+    if np.abs(cov[0,1]+cov[1,0]) <= 1e-12*np.sqrt(cov[0,0]*cov[1,1]):
+        # no cross terms (axis aligned gaussian), so the PDF is separable: only Ny+Nx exponentials needed
+        return (norm * np.exp(-0.5*yy*yy/cov[0,0])) * np.exp(-0.5*xx*xx/cov[1,1])
+
+    quad  = (cov[1,1]*yy*yy - (cov[0,1]+cov[1,0])*yy*xx + cov[0,0]*xx*xx) / det
+
+    return norm * np.exp(-0.5*quad)
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def gen_2Dsersic(size,parameters,normalize=False,show2Dsersic=False,savefits=False,verbose=True):
     """
     Generating a 2D sersic with specified parameters using astropy's generator
@@ -1084,8 +1158,9 @@ def numerical_convolution_image(imgarray,kerneltype,saveimg=False,clobber=False,
             img_conv = convolution.convolve_fft(imgarray, kernel_use, boundary='fill',
                                                 fill_value=fill_value,normalize_kernel=norm_kernel, mask=imgmask,
                                                 crop=True, return_fft=False, fft_pad=None,
-                                                psf_pad=None, interpolate_nan=False, quiet=False,
-                                                ignore_edge_zeros=False, min_wt=0.0)
+                                                psf_pad=None, nan_treatment='interpolate', min_wt=0.0,
+                                                fftn=lambda arr: scipy.fft.fftn(arr,workers=-1), # multithreaded FFTs
+                                                ifftn=lambda arr: scipy.fft.ifftn(arr,workers=-1))
         else:
             if verbose: print(' - Convolving using astropy.convolution.convolve(); interpolation over NaN values')
             img_conv = convolution.convolve(imgarray, kernel_use, boundary='fill',
@@ -1097,6 +1172,80 @@ def numerical_convolution_image(imgarray,kerneltype,saveimg=False,clobber=False,
 
     return img_conv
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+def numerical_convolution_imagestack(imgarrays,kernel,imgmask=None,fill_value=0.0,norm_kernel=False,workers=-1,verbose=True):
+    """
+    Convolve a stack of images with the same kernel. Returns the same as calling
+    tu.numerical_convolution_image(img,kernel,convolveFFT=True) for each image, but the kernel is only
+    prepared and Fourier transformed once, and the weights used for interpolating over masked pixels
+    are only computed once for the whole stack.
+
+    --- INPUT ---
+    imgarrays       numpy array containing the images to convolve. Dimensions: [Nimg,ydim,xdim]
+    kernel          numpy array containing the kernel to use for the convolution
+    imgmask         Mask of image array to apply during convolution (same for all images). Pixels in the mask
+                    or which are not finite in any of the images are interpolated over.
+    fill_value      Fill value to use in convolution
+    norm_kernel     To normalize the convolution kernel set this keyword to True
+    workers         Number of threads to use for the Fourier transforms (see scipy.fft). -1 uses all CPUs.
+    verbose         Toggle verbosity
+
+    --- EXAMPLE OF USE ---
+    import tdose_utilities as tu
+    kernel    = tu.gen_2Dgauss([31,41],tu.build_2D_cov_matrix(2,2,0),1.0)
+    img_conv  = tu.numerical_convolution_imagestack(np.ones([3,31,41]),kernel,norm_kernel=True)
+
+    """
+    imgarrays = np.asarray(imgarrays)
+    imgshape  = imgarrays.shape[1:]
+    img_conv  = np.zeros(imgarrays.shape)
+
+    if (imgshape[0] % 2 == 0) or (kernel.shape[0] % 2 == 0) or (kernel.shape[1] % 2 == 0):
+        if verbose: print(' - Convolving using scipy.ndimage.filters.convolve() as at least one dimension of kernel or image is even; ' \
+                          'no interpolation over NaN values')
+        if norm_kernel & (np.sum(kernel) != 1.0):
+            kernel = kernel/np.sum(kernel)
+        intpixcen = [kernel.shape[0]/2.0-0.5,kernel.shape[1]/2.0-0.5]
+        kernel    = tu.shift_2Dprofile(kernel,intpixcen,showprofiles=False,origin=0)
+        for ii in np.arange(int(imgarrays.shape[0])):
+            img_conv[ii,:,:] = scipy.ndimage.filters.convolve(imgarrays[ii,:,:],kernel,cval=fill_value,origin=0)
+    else:
+        if (kernel.shape[0] < imgshape[0]) or (kernel.shape[1] < imgshape[1]):
+            sys.exit(' ---> Astropy convolution requires kernel to have same size as image (but at least one size is smaller)')
+        if (kernel.shape[0] > imgshape[0]) or (kernel.shape[1] > imgshape[1]):
+            if verbose: print(' - Kernel larger than image; extracting center of kernel to use for convolution')
+            kernel = tu.get_kernelcenter(imgshape,kernel,useMaxAsCenter=True,verbose=False)
+
+        if verbose: print(' - Convolving '+str(imgarrays.shape[0])+' images in Fourier space with the same kernel')
+        kernel_scale = np.sum(kernel)
+        kernel_norm  = kernel/kernel_scale # convolve with normalized kernel as astropy.convolution.convolve_fft()
+        if norm_kernel:
+            kernel_scale = 1.0
+
+        fftshape  = [scipy.fft.next_fast_len(imgshape[ii]+kernel.shape[ii]-1,real=True) for ii in [0,1]]
+        cutout    = (slice(kernel.shape[0]//2,kernel.shape[0]//2+imgshape[0]),
+                     slice(kernel.shape[1]//2,kernel.shape[1]//2+imgshape[1]))
+        kernelfft = scipy.fft.rfftn(kernel_norm,s=fftshape,workers=workers)
+
+        badpix    = ~np.all(np.isfinite(imgarrays),axis=0)
+        if imgmask is not None:
+            badpix = badpix | imgmask
+        imgs_fill = np.where(badpix,0.0,imgarrays)
+        if fill_value != 0.0: # region outside image has the fill value
+            padimg = np.full([imgarrays.shape[0]]+fftshape,float(fill_value))
+            padimg[:,:imgshape[0],:imgshape[1]] = imgs_fill
+            imgs_fill = padimg
+
+        img_conv  = scipy.fft.irfftn(scipy.fft.rfftn(imgs_fill,s=fftshape,axes=(1,2),workers=workers)*kernelfft,
+                                     s=fftshape,axes=(1,2),workers=workers)[:,cutout[0],cutout[1]]*kernel_scale
+
+        if badpix.any(): # interpolate over masked pixels by normalizing with the convolved weights
+            weights  = 1.0 - scipy.fft.irfftn(scipy.fft.rfftn(badpix.astype(float),s=fftshape,workers=workers)*kernelfft,
+                                              s=fftshape,workers=workers)[cutout]
+            goodwt   = weights >= 10*np.finfo(float).eps
+            img_conv = np.where(goodwt,img_conv/np.where(goodwt,weights,1.0),0.0)
+
+    return img_conv
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 def get_kernelcenter(shape,kernel,useMaxAsCenter=False,verbose=True):
     """
     Cutting out kernel center (with a given shape).